@@ -0,0 +1,312 @@
+import argparse
+import io
+import math
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import networkx
+from PIL import Image
+import igo
+
+# Types of road of the synthetic streets, with their probability
+ROAD_TYPES = [('residential', 0.6), ('primary', 0.2), ('secondary', 0.1), ('tertiary', 0.05), ('living_street', 0.05)]
+# Point around which the synthetic city is placed (Barcelona)
+ORIGIN = (2.10, 41.35)
+# Distance between neighbouring nodes (degrees)
+STEP = 0.0015
+
+
+def grid_graph(side, rng):
+    '''
+    Returns a synthetic city: a digraph with a grid of side x side nodes
+    and streets in both directions between neighbours
+    Arguments:
+        side -> number of nodes of each side of the grid (int)
+        rng -> random number generator (random.Random)
+    Complexity:
+        O(side^2)
+    '''
+
+    graph = networkx.DiGraph()
+    for i in range(side):
+        for j in range(side):
+            graph.add_node(i*side + j, x=ORIGIN[0] + j*STEP, y=ORIGIN[1] + i*STEP)
+    for i in range(side):
+        for j in range(side):
+            if j+1 < side:
+                add_street(graph, i*side + j, i*side + j+1, rng)
+            if i+1 < side:
+                add_street(graph, i*side + j, (i+1)*side + j, rng)
+    return graph
+
+
+def geometric_graph(nodes, rng):
+    '''
+    Returns a synthetic city: a digraph with random nodes and streets
+    in both directions between the nodes closer than a radius
+    Arguments:
+        nodes -> number of nodes (int)
+        rng -> random number generator (random.Random)
+    Complexity:
+        O(nodes) expected
+    '''
+
+    side = math.sqrt(nodes) * STEP
+    # radius with an average of about 6 neighbours per node
+    radius = math.sqrt(6 / (math.pi * nodes)) * side
+    positions = {node: (ORIGIN[0] + rng.random()*side, ORIGIN[1] + rng.random()*side) for node in range(nodes)}
+
+    graph = networkx.DiGraph()
+    for node, (x, y) in positions.items():
+        graph.add_node(node, x=x, y=y)
+    # the nodes are grouped in cells of the size of the radius to only compare neighbours
+    cells = {}
+    for node, (x, y) in positions.items():
+        cells.setdefault((int(x / radius), int(y / radius)), []).append(node)
+    for (cx, cy), members in cells.items():
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for u in members:
+                    for v in cells.get((cx + dx, cy + dy), []):
+                        if u < v and math.dist(positions[u], positions[v]) < radius:
+                            add_street(graph, u, v, rng)
+    return graph
+
+
+def add_street(graph, u, v, rng):
+    '''
+    Auxiliar method of grid_graph and geometric_graph
+    Adds the edges in both directions of a street with a random type of road
+    Complexity:
+        O(1)
+    '''
+
+    nu, nv = graph.nodes[u], graph.nodes[v]
+    # approximate length in meters
+    length = 111000 * math.hypot((nu['x'] - nv['x']) * math.cos(math.radians(nu['y'])), nu['y'] - nv['y'])
+    road = rng.choices([road for road, p in ROAD_TYPES], [p for road, p in ROAD_TYPES])[0]
+    graph.add_edge(u, v, length=length, highway=road)
+    graph.add_edge(v, u, length=length, highway=road)
+
+
+def write_highways_csv(filename, graph, count, rng):
+    '''
+    Writes a fake highways csv with the format of the one of Barcelona,
+    each highway going through some random nearby points of the city
+    Complexity:
+        O(count)
+    '''
+
+    nodes = list(graph.nodes.values())
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write('Tram,Descripció,Coordenades\n')
+        for way_id in range(1, count + 1):
+            start = rng.choice(nodes)
+            coordinates = []
+            for k in range(rng.randint(2, 6)):
+                coordinates += [start['x'] + rng.uniform(-5, 5)*STEP, start['y'] + rng.uniform(-5, 5)*STEP]
+            file.write('{},"Highway {}","{}"\n'.format(way_id, way_id, ','.join(map(str, coordinates))))
+
+
+def write_congestions_csv(filename, count, rng):
+    '''
+    Writes a fake congestions csv with the format of the one of Barcelona
+    Complexity:
+        O(count)
+    '''
+
+    with open(filename, 'w', encoding='utf-8') as file:
+        for way_id in range(1, count + 1):
+            file.write('{}#20210101000000#{}#{}\n'.format(way_id, rng.randint(0, 6), rng.randint(0, 6)))
+
+
+def fake_snapshots(congestions, count, changed, rng):
+    '''
+    Returns fake congestion snapshots, each one from the previous one (the first, from the congestions),
+    where a fraction of the highways change their state, some of them disappearing or appearing again
+    Complexity:
+        O(count * h) where h is the number of highways
+    '''
+
+    snapshots = []
+    states = {c.way_id: c for c in congestions}
+    order = [c.way_id for c in congestions]
+    for k in range(count):
+        for way_id in order:
+            if rng.random() < changed:
+                states[way_id] = None if rng.random() < 0.1 else igo.Congestion(way_id, rng.randint(0, 6), rng.randint(0, 6))
+        snapshots.append([states[way_id] for way_id in order if states[way_id] is not None])
+    return snapshots
+
+
+def chain_updates(igraph, highways, congestions, snapshots):
+    '''
+    Updates the igraph with update_igraph from one snapshot to the next and returns the last igraph
+    Complexity:
+        same as update_igraph for each snapshot
+    '''
+
+    for snapshot in snapshots:
+        igraph = igo.update_igraph(igraph, highways, congestions, snapshot)
+        congestions = snapshot
+    return igraph
+
+
+def check_update(igraph, graph, highways, congestions):
+    '''
+    Raises AssertionError if an updated igraph is not equal to the one built from scratch with the same snapshot
+    Complexity:
+        same as build_igraph
+    '''
+
+    built = igo.build_igraph(graph, highways, congestions)
+    for key in ('congestion', 'itime', 'predicted', 'predicted_itime'):
+        differences = int((igraph.graph[key] != built.graph[key]).sum())
+        assert differences == 0, '{} edges of {} differ between update_igraph and build_igraph'.format(differences, key)
+
+
+def offline_tile(self, url, **kwargs):
+    '''
+    Tiles of the maps of the benchmark: blank, so that rendering is measured without the network
+    '''
+
+    image = io.BytesIO()
+    Image.new('RGBA', (256, 256), 'white').save(image, format='png')
+    return 200, image.getvalue()
+
+
+def time_stage(results, stage, items, function, *args):
+    '''
+    Runs a stage of the pipeline and stores its time and number of items
+    Returns the result of the stage
+    Complexity:
+        same as the stage
+    '''
+
+    start = time.perf_counter()
+    result = function(*args)
+    results[stage] = (time.perf_counter() - start, items)
+    return result
+
+
+def trace_stage(results, stage, items, function, *args):
+    '''
+    Runs a stage of the pipeline and stores its peak memory (in the current process)
+    It is slower than time_stage (tracemalloc slows down every allocation), so it is only used to measure memory
+    Returns the result of the stage
+    Complexity:
+        same as the stage
+    '''
+
+    tracemalloc.start()
+    result = function(*args)
+    results[stage] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result
+
+
+def warm_up():
+    '''
+    Imports the libraries that igo.py imports the first time they are needed,
+    so that their import time is not measured as part of a stage
+    Complexity:
+        O(1)
+    '''
+
+    import sklearn.neighbors
+    import PIL.PngImagePlugin
+
+
+def pipeline(measure, results, arguments, graph_filename, highways_filename, congestions_filename, snapshots, trips):
+    '''
+    Runs all the stages of the pipeline from the files of a synthetic city, measuring each of them
+    Complexity:
+        same as the stages
+    '''
+
+    graph = measure(results, 'get_graph', None, igo.get_graph, graph_filename, None)
+    highways = measure(results, 'download_and_build_highways', arguments.highways,
+                       igo.download_and_build_highways, highways_filename, graph, arguments.processes)
+    congestions = measure(results, 'download_congestions', arguments.highways,
+                          igo.download_congestions, congestions_filename)
+    igraph = measure(results, 'build_igraph', graph.number_of_edges(),
+                     igo.build_igraph, graph, highways, congestions)
+    updated = measure(results, 'update_igraph', len(snapshots),
+                      chain_updates, igraph, highways, congestions, snapshots)
+    # the updated igraph must be equal to the one built from scratch
+    if snapshots:
+        check_update(updated, graph, highways, snapshots[-1])
+    measure(results, 'get_landmarks', graph.number_of_nodes(), igo.get_landmarks, igraph)
+
+    paths = measure(results, 'get_shortest_path_with_ispeeds', len(trips),
+                    lambda: [igo.get_shortest_path_with_ispeeds(igraph, a, b) for a, b in trips])
+    measure(results, 'plot_path', len(paths),
+            lambda: [igo.render_path(igraph, path, arguments.map_size) for path in paths])
+
+
+def run(arguments):
+    '''
+    Runs all the stages of the pipeline on a synthetic city twice, first measuring their time
+    and then their peak memory, and returns the measures of each stage
+    Complexity:
+        same as the stages
+    '''
+
+    rng = random.Random(arguments.seed)
+    if arguments.kind == 'grid':
+        graph = grid_graph(arguments.size, rng)
+    else:
+        graph = geometric_graph(arguments.size**2, rng)
+
+    # the inputs are the same in both runs
+    nodes = list(graph.nodes.values())
+    trips = [((a['y'], a['x']), (b['y'], b['x'])) for a, b in
+             ((rng.choice(nodes), rng.choice(nodes)) for k in range(arguments.queries))]
+
+    times = {}
+    peaks = {}
+    with tempfile.TemporaryDirectory() as directory:
+        files = [os.path.join(directory, name) for name in ('city.graph', 'highways.csv', 'congestions.csv')]
+        igo.save_graph_arrays(igo.graph_to_arrays(graph), files[0])
+        write_highways_csv(files[1], graph, arguments.highways, rng)
+        write_congestions_csv(files[2], arguments.highways, rng)
+        snapshots = fake_snapshots(igo.download_congestions(files[2]), arguments.updates, arguments.changed, rng)
+        igo.CachedStaticMap.get = offline_tile
+
+        warm_up()
+        # each run loads the graph again, so nothing built by the first one is reused by the second
+        pipeline(time_stage, times, arguments, *files, snapshots, trips)
+        pipeline(trace_stage, peaks, arguments, *files, snapshots, trips)
+
+    results = []
+    for stage, (seconds, items) in times.items():
+        if items is None:
+            items = graph.number_of_edges()
+        results.append((stage, seconds, items / seconds if seconds > 0 else math.inf, items, peaks[stage]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the stages of igo.py on a synthetic city, offline')
+    parser.add_argument('--kind', choices=['grid', 'geometric'], default='grid', help='shape of the city')
+    parser.add_argument('--size', type=int, default=60, help='nodes of each side of the city')
+    parser.add_argument('--highways', type=int, default=500, help='number of highways with congestion')
+    parser.add_argument('--updates', type=int, default=10, help='congestion snapshots applied with update_igraph')
+    parser.add_argument('--changed', type=float, default=0.05, help='fraction of the highways that change in each snapshot')
+    parser.add_argument('--queries', type=int, default=50, help='number of routes')
+    parser.add_argument('--processes', type=int, default=1, help='processes that build the highways')
+    parser.add_argument('--map-size', type=int, default=400, help='size of the rendered maps')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic city')
+    arguments = parser.parse_args()
+
+    print('{:<32} {:>10} {:>14} {:>10} {:>12}'.format('stage', 'seconds', 'items/second', 'items', 'peak MiB'))
+    for stage, seconds, throughput, items, peak in run(arguments):
+        print('{:<32} {:>10.4f} {:>14.1f} {:>10} {:>12.2f}'.format(stage, seconds, throughput, items, peak / 2**20))
+    if arguments.processes > 1:
+        print('(the peak memory does not include the processes that build the highways)')
+
+
+if __name__ == '__main__':
+    main()
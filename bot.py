@@ -1,17 +1,68 @@
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-from igo import *
+from metrics import timed, span, profiled, serve_metrics
+import importlib
+import io
+import logging
+import os
+import threading
+import time
 
-PLACE = 'Barcelona, Catalonia'
-GRAPH_FILENAME = 'barcelona.graph'
 SIZE = 800
+# Number of threads that run the commands that draw maps
+WORKERS = 8
+# The highways are built in a single process: the cities are loaded in the
+# threads of the bot, and forking while other threads are running can leave
+# the new processes deadlocked (they are only built the first time, and routes.py
+# can build them beforehand with several processes)
+PROCESSES = 1
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
+# Cities the users can choose with /city, they are loaded the first time
+# someone asks for them and the least recently used ones are unloaded
+# when all of them take more than MAX_BYTES
+CITIES = [{'name': 'barcelona', 'place': 'Barcelona, Catalonia',
+           'graph_filename': 'barcelona.graph', 'highways_filename': 'barcelona.highways',
+           'geocodes_filename': 'barcelona.geocodes',
+           'highways_url': HIGHWAYS_URL, 'congestions_url': CONGESTIONS_URL}]
+DEFAULT_CITY = 'barcelona'
+MAX_BYTES = 4 * 2**30
+# The congestions are published every 15 minutes, they are asked for
+# some seconds later and again every minute while they have not changed
+REFRESH_INTERVAL = 15 * 60
+REFRESH_DELAY = 30
+REFRESH_RETRY = 60
+REFRESH_RETRIES = 10
+# If the map cannot be loaded (for instance, the network is down), it is
+# tried again after LOAD_RETRY seconds, doubling them every time up to LOAD_RETRY_MAX
+LOAD_RETRY = 30
+LOAD_RETRY_MAX = 30 * 60
+# The metrics are exported in http://localhost:METRICS_PORT/metrics, the port
+# can be changed with the IGO_METRICS_PORT environment variable (0 to disable them)
+METRICS_PORT = int(os.environ.get('IGO_METRICS_PORT', 9464))
+# A fraction of the /go commands are profiled, and the ones slower than
+# SLOW_REQUEST seconds are written in the log with their profile
+SLOW_REQUEST = 5
+PROFILE_SAMPLE = 0.05
 
-graph = get_graph(GRAPH_FILENAME, PLACE)
-highways = download_and_build_highways(HIGHWAYS_URL, graph)
+logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s', level=logging.INFO)
+
+# The bot starts answering at once, while igo (and the libraries it uses)
+# is imported and the default city is loaded in the background by load_map.
+# Until then, the commands that need the map tell the users the stage of
+# the startup.
+igo = None
+registry = None
+startup = {'stage': 'importing'}
+# Cities whose congestions are being refreshed, so that only one job per
+# city is scheduled at a time
+refreshing = set()
+refreshing_lock = threading.Lock()
+startup_texts = {'importing': "I have just woken up, try again in a few seconds.",
+                 'loading': "I am loading the map of the city, try again in a minute.",
+                 'failed': "I could not load the map, I will try again in a few minutes."}
 
 start_text = "Hi, I'm iGoBot! \nThe bot that will change your live. \nIn order to be usefull I will need your location. If you dont know how to use me, write the /help command"
-help_text = "You can control me by sending this commands: \n \n /author: show the name of the project authors. \n /go: show a map with the path to arrive to your destination. \n /where: show a map whith your location. \n /congestions: show a map with the congestions. "
+help_text = "You can control me by sending this commands: \n \n /author: show the name of the project authors. \n /go: show a map with the path to arrive to your destination. \n /where: show a map whith your location. \n /congestions: show a map with the congestions. \n /city: change the city of the maps. "
 author_text = "The project authors are Víctor Conchello and Gerard Comas."
 
 
@@ -22,14 +73,6 @@ def start(update, context):
     Complexity:
         O(1)
     '''
-    # If it is the first time that the /start command is used since the
-    # last execution of the bot, the 'congestions' attribute will not exist.
-    if 'congestions' not in context.bot_data:
-        context.bot_data['congestions'] = False
-    # If it is the first time that the /start command is used since the last
-    # execution of the bot, the 'igraph' attribute will not exist.
-    if 'igraph' not in context.bot_data:
-        context.bot_data['igraph'] = False
     # When the /start command is used, it restarts the location.
     context.user_data['location'] = None
     context.bot.send_message(chat_id=update.effective_chat.id,
@@ -56,47 +99,53 @@ def author(update, context):
                              text=author_text)
 
 
+@timed('bot.go')
+@profiled('go', SLOW_REQUEST, PROFILE_SAMPLE)
 def go(update, context):
     '''
     Show a map with the path to arrive to your destination.
     You must write a destination.
     Complexity:
-        same as do_path, except when congestions have to be updated,
-        in that case same as build_igraph.
+        same as do_path_image
     '''
     message = update.message.text[4:]
     if len(message) == 0:
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="You must write a destination.")
         return
-    update_congestions(update, context)
-    destination = read_pos(message)
+    if not is_ready(update, context):
+        return
+    loaded = get_snapshot(update, context)
+    if loaded is None:
+        return
+    destination = read_pos(message, loaded.geocode_cache)
     if context.user_data['location'] is not None:
         origin = context.user_data['location']
     else:
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="I don't know your location, please it to me.")
         return
-    file = "path.png"
     try:
-        do_path(context.bot_data['igraph'], origin, destination, file, SIZE)
+        # The map is rendered in memory, so several users can ask at the same time
+        image = igo.do_path_image(loaded.snapshot.igraph, origin, destination, SIZE, loaded.geocode_cache,
+                                  time_dependent=True, route_cache=loaded.route_cache)
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="You have to follow this path:")
-        context.bot.send_photo(chat_id=update.effective_chat.id,
-                               photo=open(file, 'rb'))
-        # Remove the file to free up memory space
-        os.remove(file)
+        with span('telegram.send_photo'):
+            context.bot.send_photo(chat_id=update.effective_chat.id,
+                                   photo=io.BytesIO(image))
     except Exception as e:
-        print(e)
+        logging.exception(e)
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="There is no path between your location and your destination.")
 
 
+@timed('bot.where')
 def where(update, context):
     '''
     Show a map whith your location.
     Complexity:
-        same as StaticMap functions
+        same as render_location
     '''
     if context.user_data['location'] is None:
         context.bot.send_message(chat_id=update.effective_chat.id,
@@ -104,33 +153,37 @@ def where(update, context):
         return
     else:
         lat, lon = context.user_data['location']
-    file = "where.png"
-    map = StaticMap(SIZE, SIZE)
-    map.add_marker(CircleMarker((lon, lat), 'blue', 15))
-    map.render().save(file)
+    if not is_ready(update, context):
+        return
+    image = igo.render_location(lat, lon, SIZE)
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text="You are here:")
-    context.bot.send_photo(chat_id=update.effective_chat.id,
-                           photo=open(file, 'rb'))
-    os.remove(file)
+    with span('telegram.send_photo'):
+        context.bot.send_photo(chat_id=update.effective_chat.id,
+                               photo=io.BytesIO(image))
 
 
+@timed('bot.congestions')
 def congestions(update, context):
     '''
     Plot the congestions.
     Complexity:
-        same as plot_congetions, except when congestions have to be updated,
-        in that case same as build_igraph.
+        same as render_congestions
     '''
-    update_congestions(update, context)
+    if not is_ready(update, context):
+        return
+    loaded = get_snapshot(update, context)
+    if loaded is None:
+        return
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text="Here you have the congestions:")
-    plot_congestions(highways, context.bot_data['congestions'],
-                     "congestions.png", SIZE)
-    context.bot.send_photo(chat_id=update.effective_chat.id,
-                           photo=open("congestions.png", 'rb'))
+    image = igo.render_congestions(loaded.highways, loaded.snapshot.congestions, SIZE)
+    with span('telegram.send_photo'):
+        context.bot.send_photo(chat_id=update.effective_chat.id,
+                               photo=io.BytesIO(image))
 
 
+@timed('bot.pos')
 def pos(update, context):
     '''
     Change the location of the user You must write a location.
@@ -142,22 +195,70 @@ def pos(update, context):
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="You must write a location.")
         return
-    context.user_data['location'] = read_pos(message)
+    if not is_ready(update, context):
+        return
+    # Only the geocode cache of the city is needed, so the city is not loaded
+    geocode_cache = igo.get_geocode_cache(registry, context.user_data.get('city', DEFAULT_CITY))
+    context.user_data['location'] = read_pos(message, geocode_cache)
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text="Location change completed successfully.")
 
 
-def read_pos(position):
+def city(update, context):
     '''
-    Read a position and return the position with the appropiate format.
+    Change the city of the user. You must write one of the cities,
+    otherwise it shows the city of the user and the available ones.
     Complexity:
         O(1)
     '''
+    message = update.message.text[6:].strip().lower()
+    names = [city['name'] for city in CITIES]
+    if message not in names:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Your city is {}. The available cities are: {}.".format(
+                                     context.user_data.get('city', DEFAULT_CITY), ', '.join(names)))
+        return
+    context.user_data['city'] = message
+    context.bot.send_message(chat_id=update.effective_chat.id,
+                             text="City change completed successfully.")
+
+
+def read_pos(position, geocode_cache):
+    '''
+    Read a position and return the position with the appropiate format.
+    Complexity:
+        O(1), except when the position has to be geocoded,
+        in that case same as geocode.
+    '''
     separate = position.split(' ')
     try:
         return (float(separate[0]), float(separate[1]))
     except Exception as e:
-        return osmnx.geocode(position + ", Barcelona")
+        return igo.geocode(geocode_cache, position)
+
+
+def get_user_city(context):
+    '''
+    Return the city of the user, loading it if nobody has asked for it
+    for a while.
+    Complexity:
+        same as get_city
+    '''
+    return igo.get_city(registry, context.user_data.get('city', DEFAULT_CITY))
+
+
+def is_ready(update, context):
+    '''
+    Return whether the map is ready, telling the user the stage of the
+    startup otherwise.
+    Complexity:
+        O(1)
+    '''
+    stage = startup['stage']
+    if stage != 'ready':
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text=startup_texts[stage])
+    return stage == 'ready'
 
 
 def get_loc(update, context):
@@ -172,47 +273,149 @@ def get_loc(update, context):
                              text="Received.")
 
 
-def update_congestions(update, context):
+def get_snapshot(update, context):
     '''
-    Load the congestions if they are not updated.
+    Return the city of the user with its last congestion snapshot (congestions
+    and igraph built with them), or None, telling it to the user and asking
+    for the congestions, if the first one is not ready yet.
     Complexity:
-        same as build_igraph
+        same as get_user_city
     '''
-    new_congestions = download_congestions(CONGESTIONS_URL)
-    # The congestion changes every 15 minutes, if there is a change the
-    # congestions will have to be reloaded
-    if new_congestions != context.bot_data['congestions']:
+    # The snapshot is replaced as a whole by refresh_city, and its igraph
+    # is never changed, so the commands that are still using the previous
+    # one keep seeing it whole
+    loaded = get_user_city(context)
+    if loaded.snapshot is None:
+        schedule_refresh(context.job_queue, loaded.city.name, 0)
         context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="I have to update the map, wait a few seconds.")
-        context.bot_data['congestions'] = new_congestions
-        message = context.bot.send_message(chat_id=update.effective_chat.id,
-                                           text="0%")
-        # It will reload also the igraf to avoid problems with versions
-        context.bot_data['igraph'] = build_igraph(graph, highways, context.bot_data['congestions'],
-                                                  context,  update.effective_chat.id, message.message_id)
+                                 text="I am still loading the map, try again in a few seconds.")
+        return None
+    return loaded
+
+
+@timed('bot.refresh_congestions')
+def refresh_congestions(context):
+    '''
+    Job that downloads the congestions of a city if they have changed and
+    builds its new igraph in the background, outside of the handlers of the
+    commands. If they have not been published yet, it tries again a minute later.
+    Complexity:
+        same as refresh_city
+    '''
+    name, retries = context.job.context
+    try:
+        refreshed = igo.refresh_city(registry, name)
+    except Exception:
+        with refreshing_lock:
+            refreshing.discard(name)
+        raise
+    if not refreshed and retries and name in igo.loaded_cities(registry):
+        # The congestions are published every 15 minutes, but maybe not yet
+        # (the city is still being refreshed, so the retry is scheduled directly)
+        context.job_queue.run_once(refresh_congestions, REFRESH_RETRY, context=(name, retries - 1))
+        return
+    with refreshing_lock:
+        refreshing.discard(name)
+
+
+def schedule_refresh(job_queue, name, retries=REFRESH_RETRIES):
+    '''
+    Schedule a job that refreshes the congestions of a city, unless
+    one is already pending for it.
+    Complexity:
+        O(1)
+    '''
+    with refreshing_lock:
+        if name in refreshing:
+            return
+        refreshing.add(name)
+    job_queue.run_once(refresh_congestions, 0, context=(name, retries))
+
+
+def refresh_cities(context):
+    '''
+    Job that refreshes the congestions of all the loaded cities.
+    Complexity:
+        O(k) where k is the number of loaded cities
+    '''
+    for name in igo.loaded_cities(registry):
+        schedule_refresh(context.job_queue, name)
+
+
+@timed('bot.load_map')
+def load_map(context):
+    '''
+    Job that imports igo and loads the default city in the background, while
+    the bot is already answering, and then starts refreshing the congestions.
+    If it fails, it is scheduled again later, waiting more after every failure.
+    Complexity:
+        same as get_city
+    '''
+    global igo, registry
+    failures = context.job.context or 0
+    try:
+        igo = importlib.import_module('igo')
+        startup['stage'] = 'loading'
+        if registry is None:
+            registry = igo.new_city_registry([igo.City(**city) for city in CITIES], MAX_BYTES, PROCESSES)
+        igo.get_city(registry, DEFAULT_CITY)
+    except Exception as e:
+        logging.exception(e)
+        startup['stage'] = 'failed'
+        delay = min(LOAD_RETRY * 2**failures, LOAD_RETRY_MAX)
+        logging.warning("the map could not be loaded, trying again in %d seconds", delay)
+        context.job_queue.run_once(load_map, delay, context=failures + 1)
+        return
+    startup['stage'] = 'ready'
+    logging.info("map loaded")
+
+    # The congestions are loaded now and refreshed every 15 minutes in the background
+    schedule_refresh(context.job_queue, DEFAULT_CITY)
+    context.job_queue.run_repeating(refresh_cities, REFRESH_INTERVAL, first=seconds_to_next_refresh())
+
+
+def seconds_to_next_refresh():
+    '''
+    Return the seconds until the congestions of the next 15 minutes are published.
+    Complexity:
+        O(1)
+    '''
+    return REFRESH_INTERVAL - time.time() % REFRESH_INTERVAL + REFRESH_DELAY
 
 
 # Declare a constant amb the access token that got from token.txt
 TOKEN = open('token.txt').read().strip()
 
 # Creates objects to work with Telegram
-updater = Updater(token=TOKEN, use_context=True)
+updater = Updater(token=TOKEN, use_context=True, workers=WORKERS)
 dispatcher = updater.dispatcher
 
 # Indicates that when the bot receives the /*command*,
 # the *command* function is executed
+# (the ones that draw maps run in the worker threads, so they do not block the rest)
 dispatcher.add_handler(CommandHandler('start', start))
 dispatcher.add_handler(CommandHandler('help', help))
 dispatcher.add_handler(CommandHandler('author', author))
-dispatcher.add_handler(CommandHandler('go', go))
-dispatcher.add_handler(CommandHandler('where', where))
-dispatcher.add_handler(CommandHandler('pos', pos))
-dispatcher.add_handler(CommandHandler('congestions', congestions))
+dispatcher.add_handler(CommandHandler('go', go, run_async=True))
+dispatcher.add_handler(CommandHandler('where', where, run_async=True))
+dispatcher.add_handler(CommandHandler('pos', pos, run_async=True))
+dispatcher.add_handler(CommandHandler('city', city))
+dispatcher.add_handler(CommandHandler('congestions', congestions, run_async=True))
 
 # When the bot receives a location, the get_loc function is executed
 dispatcher.add_handler(MessageHandler(Filters.location, get_loc))
 
+# The map is loaded in the background, the bot answers meanwhile
+updater.job_queue.run_once(load_map, 0)
+
+# Export the metrics (the bot works without them if the port is taken)
+if METRICS_PORT:
+    try:
+        serve_metrics(METRICS_PORT)
+    except OSError as e:
+        logging.warning("the metrics are not exported, port %d: %s", METRICS_PORT, e)
+
 # Start the bot
 updater.start_polling()
 
-print("all done")
+logging.info("all done")
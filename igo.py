@@ -1,318 +1,1772 @@
 import collections
-import osmnx
+import functools
+import networkx
 import pickle
-import urllib
+import urllib.request
+import urllib.error
 import csv
 import os
+import hashlib
+import io
+import itertools
+import heapq
+import math
+import multiprocessing
+import threading
+import concurrent.futures
+import numpy as np
 from staticmap import Line, StaticMap, CircleMarker
+from metrics import timed, count, span, logger
+
+# Each highway has a vector of all the edges of the graph it goes through (their edge_id), its coordinates
+# and the segments (the i-th goes from the i-th coordinate to the next one) that could not be matched to the graph
+Highway = collections.namedtuple('Highway', 'description, edges, coordinates, unmatched')
+# All the highways of a city stored in columns: the edges of the i-th row are
+# edges[edge_offsets[i]:edge_offsets[i+1]], its coordinates are coordinates[coordinate_offsets[i]:coordinate_offsets[i+1]]
+# and its unmatched segments are unmatched[unmatched_offsets[i]:unmatched_offsets[i+1]], and rows gives the row of each way_id
+# The edges of all the highways are also sorted in covered_edges, with the row of the highway of each one
+# in covering_rows, so the highways that cover an edge are found with a binary search
+HighwayStore = collections.namedtuple('HighwayStore', 'rows, way_ids, descriptions, edge_offsets, edges, '
+                                                      'coordinate_offsets, coordinates, unmatched_offsets, unmatched, '
+                                                      'covered_edges, covering_rows')
+# Quality of the matching of the highways to the graph: number of highways and of segments,
+# number of unmatched segments and the way_id, description and unmatched segments of each highway with some of them
+MatchReport = collections.namedtuple('MatchReport', 'highways, segments, unmatched, failed')
+Congestion = collections.namedtuple('Congestion', 'way_id, current, predicted')
+# Spatial index of the nodes of a graph: node ids, KD-tree over their projected coordinates
+# and the scale applied to the longitudes to project them
+NodeIndex = collections.namedtuple('NodeIndex', 'nodes, tree, x_scale')
+# Static attributes of the edges of a graph, as arrays indexed by the 'edge_id' of each edge
+EdgeTable = collections.namedtuple('EdgeTable', 'edges, length, maxspeed, time')
+# Compact storage of a graph: node ids and coordinates, adjacency in CSR format
+# and the attributes of the edges in the same order as the adjacency
+GraphArrays = collections.namedtuple('GraphArrays', 'nodes, x, y, indptr, indices, length, maxspeed')
+# Adjacency of a graph as lists (faster than arrays to read one element at a time):
+# position of each node in the arrays of the graph and adjacency in CSR format
+Adjacency = collections.namedtuple('Adjacency', 'positions, indptr, indices')
+# Preprocessing of the ALT routing (A*, landmarks and triangle inequality): chosen landmarks and,
+# for each node, the lower bounds of the time from each landmark to it and from it to each landmark
+Landmarks = collections.namedtuple('Landmarks', 'landmarks, from_landmark, to_landmark')
+# Graph prepared for the matching of the highways, as lists indexed by the position of the nodes:
+# adjacency and reversed adjacency (with the edge_id of its edges) in CSR format,
+# length of the edges and coordinates of the nodes in meters
+MatchIndex = collections.namedtuple('MatchIndex', 'indptr, indices, reverse_indptr, reverse_indices, reverse_edges, length, x, y')
+# Cache of geocoded queries: function that geocodes a query, coordinates of the normalized queries
+# from the least to the most recently used, maximum number of queries, file where it is stored (or None) and its lock
+GeocodeCache = collections.namedtuple('GeocodeCache', 'backend, entries, capacity, filename, lock')
+# Cache of routes: path and image of each (version, origin, destination, mode, size) from the least to the most
+# recently used, maximum number of routes and of bytes of images, its lock and its statistics (bytes, hits, misses)
+RouteCache = collections.namedtuple('RouteCache', 'entries, capacity, max_bytes, lock, stats')
+# A city served by the bot: its name, the place osmnx downloads and geocodes,
+# the files where its graph, highways and geocodes are kept and the urls of its highways and congestions
+City = collections.namedtuple('City', 'name, place, graph_filename, highways_filename, geocodes_filename, highways_url, congestions_url')
+# Last congestion snapshot of a city: its congestions, the igraph built with them and the validators of their download
+Snapshot = collections.namedtuple('Snapshot', 'congestions, igraph, validators')
+# A city loaded in memory: its graph, highways and caches, its last snapshot (None until the first one is downloaded)
+# and the approximate bytes it takes
+LoadedCity = collections.namedtuple('LoadedCity', 'city, graph, highways, geocode_cache, route_cache, snapshot, nbytes')
+# Registry of the cities: each city by name, the loaded ones from the least to the most recently used,
+# maximum number of bytes of the loaded cities, processes that build the highways, its lock,
+# the lock that loads each city, its statistics (bytes, loads, evictions) and the geocode cache of each city
+# (kept apart from the loaded cities, so addresses can be geocoded without loading the city)
+CityRegistry = collections.namedtuple('CityRegistry',
+                                      'cities, entries, max_bytes, processes, lock, loading, stats, geocode_caches')
+
+# each congestion type multiplies the time a given amount
+MULTIPLIERS = np.array([1.1, 1, 1.2, 1.5, 2, 4, 1e12])
+# the time of the edges is their length (m) divided by their maxspeed (km/h), which is 3.6 seconds
+SECONDS_PER_TIME = 3.6
+# seconds after which the predicted congestion is used instead of the current one
+PREDICTION_HORIZON = 15 * 60
+# directory where the tiles of the maps are kept
+TILES_DIRECTORY = 'tiles'
+# number of rendered congestion maps that are kept
+CONGESTION_IMAGES = 4
+# if more than this fraction of the highways change between two snapshots,
+# the igraph is built again instead of updating their edges one by one
+UPDATE_FRACTION = 0.25
+# the path of a segment of a highway can go at most this many meters farther than the segment
+# (it only visits the nodes whose distances to both ends add up to the segment plus twice this)
+MATCH_RADIUS = 250
+# meters of a degree of latitude
+METERS_PER_DEGREE = 111320
+# approximate bytes a loaded graph takes per edge (dictionaries of networkx, arrays,
+# adjacency lists, landmarks and weights of its igraphs), measured with tracemalloc
+EDGE_BYTES = 1024
+
+
+@timed()
+def get_graph(GRAPH_FILENAME, PLACE):
+    '''
+    Returns the digraph of the streets of a city
+        getting it from a file if it has already been stored there
+        storing it in the file otherwise
+    The file is a directory of numpy arrays (see save_graph_arrays), smaller and faster to load than
+    a pickled digraph; it does not save memory, because each process that loads it builds its own digraph,
+    adjacency lists and landmarks from the arrays (see graph_from_arrays)
+    Arguments:
+        GRAPH_FILENAME -> filename of the graph (string ended in ".graph")
+        PLACE -> name of the city (string)
+    Complexity:
+        if graph alrady in file -> O(n + m) where n and m are the number of nodes and edges
+        otherwise -> same as osmnx.graph_from_place
+    '''
+
+    # graphs stored by older versions are pickled digraphs, convert them to the new format
+    # (the pickle is moved aside and only removed once the arrays are stored, so it is never lost)
+    legacy = GRAPH_FILENAME + '.pickle'
+    if os.path.isfile(GRAPH_FILENAME):
+        os.replace(GRAPH_FILENAME, legacy)
+    if os.path.isfile(legacy):
+        with open(legacy, 'rb') as file:
+            arrays = graph_to_arrays(pickle.load(file))
+        save_graph_arrays(arrays, GRAPH_FILENAME)
+        os.remove(legacy)
+
+    try:
+        # if it is already stored in the file, simply load it
+        return graph_from_arrays(load_graph_arrays(GRAPH_FILENAME))
+
+    except FileNotFoundError:
+        # otherwise download it
+        # osmnx takes seconds to import and is only needed to download new graphs and geocode
+        import osmnx
+        multi_graph = osmnx.graph_from_place(PLACE, network_type='drive', simplify=True)
+        graph = osmnx.get_digraph(multi_graph, weight='length')
+
+        # and store it into the file before returning it
+        save_graph_arrays(graph_to_arrays(graph), GRAPH_FILENAME)
+        return graph_from_arrays(load_graph_arrays(GRAPH_FILENAME))
+
+
+def graph_to_arrays(graph):
+    '''
+    Auxiliar method of get_graph
+    Returns the arrays of a graph: coordinates of the nodes, adjacency in CSR format
+    (the edges leaving the i-th node are indices[indptr[i]:indptr[i+1]])
+    and length and maxspeed of the edges in the same order
+    Arguments:
+        graph -> graph of the streets
+    Complexity:
+        O(n + m) where n and m are the number of nodes and edges
+    '''
+
+    nodes = np.array(list(graph.nodes), dtype=np.int64)
+    position = {node: i for i, node in enumerate(graph.nodes)}
+    x = np.array([info['x'] for node, info in graph.nodes.items()], dtype=float)
+    y = np.array([info['y'] for node, info in graph.nodes.items()], dtype=float)
+
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    indices = np.empty(graph.number_of_edges(), dtype=np.int64)
+    length = np.empty(graph.number_of_edges())
+    maxspeed = np.empty(graph.number_of_edges())
+    e = 0
+    for i, node in enumerate(graph.nodes):
+        for neighbour, info in graph.adj[node].items():
+            indices[e] = position[neighbour]
+            length[e] = info['length']
+            maxspeed[e] = edge_maxspeed(info)
+            e += 1
+        indptr[i+1] = e
+
+    return GraphArrays(nodes, x, y, indptr, indices, length, maxspeed)
+
+
+def save_graph_arrays(arrays, GRAPH_FILENAME):
+    '''
+    Auxiliar method of get_graph
+    Stores the arrays of a graph in a directory, one ".npy" file per array
+    Arguments:
+        arrays -> arrays of the graph (GraphArrays)
+        GRAPH_FILENAME -> filename of the graph (string ended in ".graph")
+    Complexity:
+        O(n + m) where n and m are the number of nodes and edges
+    '''
+
+    # write into a temporary directory first, so that a half written graph is never loaded
+    temporary = GRAPH_FILENAME + '.tmp'
+    os.makedirs(temporary, exist_ok=True)
+    for name, array in arrays._asdict().items():
+        np.save(os.path.join(temporary, name + '.npy'), array)
+    os.replace(temporary, GRAPH_FILENAME)
+
+
+def load_graph_arrays(GRAPH_FILENAME):
+    '''
+    Auxiliar method of get_graph
+    Returns the arrays of a graph stored with save_graph_arrays, memory mapped (not read until used,
+    and then copied by graph_from_arrays into the digraph)
+    Arguments:
+        GRAPH_FILENAME -> filename of the graph (string ended in ".graph")
+    Complexity:
+        O(1)
+    '''
+
+    return GraphArrays(*(np.load(os.path.join(GRAPH_FILENAME, name + '.npy'), mmap_mode='r')
+                         for name in GraphArrays._fields))
+
+
+def graph_from_arrays(arrays):
+    '''
+    Auxiliar method of get_graph
+    Returns the digraph of the streets with the arrays of a graph,
+    with the coordinates of the nodes and the length, maxspeed and edge_id of the edges
+    (the edge table of the graph is built directly from the arrays, but the digraph itself is
+    a regular networkx one, so each process that calls this keeps its own copy in memory)
+    Arguments:
+        arrays -> arrays of the graph (GraphArrays)
+    Complexity:
+        O(n + m) where n and m are the number of nodes and edges
+    '''
+
+    graph = networkx.DiGraph(arrays=arrays)
+    nodes = arrays.nodes.tolist()
+    for node, x, y in zip(nodes, arrays.x.tolist(), arrays.y.tolist()):
+        graph.add_node(node, x=x, y=y)
+
+    sources = np.repeat(arrays.nodes, np.diff(arrays.indptr)).tolist()
+    targets = arrays.nodes[arrays.indices].tolist()
+    graph.add_edges_from((u, v, {'length': length, 'maxspeed': maxspeed, 'edge_id': i})
+                         for i, (u, v, length, maxspeed)
+                         in enumerate(zip(sources, targets, arrays.length.tolist(), arrays.maxspeed.tolist())))
+
+    length = np.asarray(arrays.length)
+    graph.graph['edge_table'] = EdgeTable(list(zip(sources, targets)), length,
+                                          np.asarray(arrays.maxspeed), length / arrays.maxspeed)
+    return graph
+
+
+@timed()
+def get_highways(HIGHWAYS_URL, graph, GRAPH_FILENAME, HIGHWAYS_FILENAME, processes=1):
+    '''
+    Returns the highways of a city
+        getting them from a file if they have already been built with the same graph and highways data
+        building and storing them in the file otherwise
+    Arguments:
+        HIGHWAYS_URL -> url or filename where the highways are (string)
+        graph -> graph of the city
+        GRAPH_FILENAME -> filename of the graph (string ended in ".graph")
+        HIGHWAYS_FILENAME -> filename of the highways (string ended in ".highways")
+        processes -> number of processes that build the highways (int)
+    Complexity:
+        if highways already in file with the same key -> same as pickle.load (plus reading the csv)
+        otherwise -> same as build_highways
+    '''
+
+    # the csv is hashed while it is read, line by line, so it is never kept whole in memory
+    graph_digest = highways_digest_of_graph(GRAPH_FILENAME)
+    try:
+        with open(HIGHWAYS_FILENAME, 'rb') as file:
+            stored = pickle.load(file)
+        digest = graph_digest.copy()
+        for line in hash_lines(open_lines(HIGHWAYS_URL), digest):
+            pass
+        # if they are already built with the same inputs, simply return them
+        if stored['key'] == digest.hexdigest():
+            return stored['highways']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+        pass
+
+    # otherwise build them while the csv is read again, hashing it at the same time
+    digest = graph_digest.copy()
+    highways = build_highways(hash_lines(open_lines(HIGHWAYS_URL), digest), graph, processes)
+
+    # and store them into the file before returning them
+    with open(HIGHWAYS_FILENAME, 'wb') as file:
+        pickle.dump({'key': digest.hexdigest(), 'highways': highways}, file)
+    return highways
+
+
+def highways_digest_of_graph(GRAPH_FILENAME):
+    '''
+    Auxiliar method of get_highways
+    Returns the hash (hashlib object) of the inputs the highways are built from, except the csv,
+    which is added with hash_lines to get the key of the highways
+    Arguments:
+        GRAPH_FILENAME -> filename of the graph (string ended in ".graph")
+    Complexity:
+        O(g) where g is the size of the graph file
+    '''
+
+    # the format of the stored highways is part of the key, so files of older versions are rebuilt
+    digest = hashlib.sha256(' '.join((HighwayStore.__name__,) + HighwayStore._fields).encode('utf-8'))
+    # the graph is a directory of arrays (see save_graph_arrays)
+    for name in sorted(os.listdir(GRAPH_FILENAME)):
+        with open(os.path.join(GRAPH_FILENAME, name), 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest
+
+
+def hash_lines(lines, digest):
+    '''
+    Auxiliar method of get_highways
+    Returns an iterator over the lines that adds each of them to the hash as it is read
+    Arguments:
+        lines -> lines of the highways csv (iterable of strings)
+        digest -> hash the lines are added to (hashlib object)
+    Complexity:
+        O(l) for each line, where l is its length
+    '''
+
+    for line in lines:
+        digest.update(line.encode('utf-8'))
+        yield line
+
+
+def download_and_build_highways(HIGHWAYS_URL, graph, processes=1):
+    '''
+    Returns the highways of a city from the web (or from a local file)
+    The csv is read line by line while it is being downloaded
+    Arguments:
+        HIGHWAYS_URL -> url or filename where the highways are (string)
+        graph -> graph of the city
+        processes -> number of processes that build the highways (int)
+    Complexity:
+        same as build_highways
+    '''
+
+    return build_highways(open_lines(HIGHWAYS_URL), graph, processes)
+
+
+def open_lines(source):
+    '''
+    Returns an iterator over the decoded lines of a url or a local file,
+    which reads them as they are needed instead of all at once
+    Arguments:
+        source -> url or filename (string)
+    Complexity:
+        O(1) for each line (plus the time to receive it)
+    '''
+
+    if os.path.exists(source):
+        with open(source, encoding='utf-8', newline='') as file:
+            yield from file
+    else:
+        with urllib.request.urlopen(source) as response:
+            yield from io.TextIOWrapper(response, encoding='utf-8', newline='')
+
+
+@timed()
+def build_highways(lines, graph, processes=1):
+    '''
+    Returns the highways of a city with the edges of the graph they go through (HighwayStore)
+    Arguments:
+        lines -> lines of the highways csv (iterable of strings)
+        graph -> graph of the city
+        processes -> number of processes that build the highways (int),
+            each of them receives the graph only once
+    Complexity:
+        O(n) where n is the number of highways (divided among the processes)
+    '''
+
+    # read them and store them in a vector
+    reader = csv.reader(lines, delimiter=',', quotechar='"')
+    next(reader)    # ignore first line with description
+
+    # the node index, the edge_ids, the adjacency and the match index are built before creating the processes
+    # so that all of them share them
+    get_node_index(graph)
+    get_edge_table(graph)
+    get_adjacency(graph)
+    get_match_index(graph)
+
+    if processes > 1:
+        with multiprocessing.Pool(processes, initializer=init_highways_worker, initargs=(graph,)) as pool:
+            built = pool.imap(build_highway_in_worker, reader, chunksize=64)
+            highways = store_highways(built)
+    else:
+        highways = store_highways(build_highway(line, graph) for line in reader)
+
+    # the segments that could not be matched are reported instead of silently dropped
+    report = match_report(highways)
+    count('highway_segments', report.segments)
+    count('highway_segments_unmatched', report.unmatched)
+    if report.unmatched:
+        logger.warning('%d of the %d segments of the highways could not be matched to the graph (%d highways), e.g. %s',
+                       report.unmatched, report.segments, len(report.failed), report.failed[:5])
+    return highways
+
+
+def store_highways(built):
+    '''
+    Auxiliar method of build_highways
+    Returns the store with all the highways
+    Arguments:
+        built -> pairs of way_id and highway (iterable)
+    Complexity:
+        O(h + e log e + k) where h is the number of highways, e the number of their edges
+        and k the number of their coordinates
+    '''
+
+    way_ids = []
+    descriptions = []
+    edges = []
+    coordinates = []
+    unmatched = []
+    for way_id, highway in built:
+        way_ids.append(way_id)
+        descriptions.append(highway.description)
+        edges.append(np.asarray(highway.edges, dtype=np.int64))
+        coordinates.append(np.asarray(highway.coordinates, dtype=float).reshape(-1, 2))
+        unmatched.append(np.asarray(highway.unmatched, dtype=np.int64))
+
+    # the row of each way_id, to locate its congestion later
+    rows = {way_id: row for row, way_id in enumerate(way_ids)}
+    edge_offsets = column_offsets(edges)
+    edges = np.concatenate(edges) if edges else np.zeros(0, dtype=np.int64)
+    # the highways that cover each edge, to update only some edges later (see update_igraph)
+    order = np.argsort(edges, kind='stable')
+    edge_rows = np.repeat(np.arange(len(way_ids), dtype=np.int64), np.diff(edge_offsets))
+    return HighwayStore(rows, np.array(way_ids, dtype=np.int64), descriptions, edge_offsets, edges,
+                        column_offsets(coordinates), np.concatenate(coordinates) if coordinates else np.zeros((0, 2)),
+                        column_offsets(unmatched), np.concatenate(unmatched) if unmatched else np.zeros(0, dtype=np.int64),
+                        edges[order], edge_rows[order])
+
+
+def column_offsets(values):
+    '''
+    Auxiliar method of store_highways
+    Returns the offsets of the rows of a column: the i-th row goes from offsets[i] to offsets[i+1]
+    Arguments:
+        values -> values of each row (vector of arrays)
+    Complexity:
+        O(h) where h is the number of rows
+    '''
+
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(v) for v in values])
+    return offsets
+
+
+def match_report(highways):
+    '''
+    Returns the quality of the matching of the highways to the graph (MatchReport)
+    Arguments:
+        highways -> streets whose congestions we know (HighwayStore)
+    Complexity:
+        O(h + u) where h is the number of highways and u the number of unmatched segments
+    '''
+
+    # a highway with k coordinates has k-1 segments
+    segments = int(np.maximum(np.diff(highways.coordinate_offsets) - 1, 0).sum())
+    failed = []
+    for row in np.flatnonzero(np.diff(highways.unmatched_offsets)).tolist():
+        unmatched = highways.unmatched[highways.unmatched_offsets[row]:highways.unmatched_offsets[row+1]]
+        failed.append((int(highways.way_ids[row]), highways.descriptions[row], unmatched.tolist()))
+    return MatchReport(len(highways.way_ids), segments, len(highways.unmatched), failed)
+
+
+def highway_coordinates(highways, way_id):
+    '''
+    Returns the coordinates of a highway (array with a row (longitude, latitude) for each point)
+    Arguments:
+        highways -> streets whose congestions we know (HighwayStore)
+        way_id -> id of the highway (int)
+    Complexity:
+        O(1)
+    '''
+
+    row = highways.rows[way_id]
+    return highways.coordinates[highways.coordinate_offsets[row]:highways.coordinate_offsets[row+1]]
+
+
+def gather_highway_edges(highways, way_ids):
+    '''
+    Returns the edge_ids of the edges of some highways, one highway after another,
+    and the number of edges of each highway (0 for the way_ids that are not in the store)
+    Arguments:
+        highways -> streets whose congestions we know (HighwayStore)
+        way_ids -> ids of the highways (vector of ints)
+    Complexity:
+        O(w + e) where w is the number of way_ids and e the number of their edges
+    '''
+
+    # with no highways in the store (an empty csv), no way_id has edges
+    if len(highways.way_ids) == 0:
+        return np.zeros(0, dtype=highways.edges.dtype), np.zeros(len(way_ids), dtype=np.int64)
+
+    rows = [highways.rows.get(way_id) for way_id in way_ids]
+    known = np.array([row is not None for row in rows], dtype=bool)
+    rows = np.array([0 if row is None else row for row in rows], dtype=np.int64)
+    starts = highways.edge_offsets[rows]
+    counts = np.where(known, highways.edge_offsets[rows + 1] - starts, 0)
+
+    # positions of the edges of each highway, without a loop over the highways
+    positions = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return highways.edges[positions], counts
+
+
+def build_highway(line, graph):
+    '''
+    Auxiliar method of build_highways
+    Returns the way_id and the highway of a line of the highways csv
+    Arguments:
+        line -> fields of the line (vector of strings)
+        graph -> graph of the city
+    Complexity:
+        O(k * d) where k is the number of coordinates and d the cost of match_segment
+    '''
+
+    way_id, description, coordinates = line
+    way_id = int(way_id)
+    # change the format of coordinates for an easier use
+    coordinates = get_nice_coordinates(coordinates)
+
+    # snap all the coordinates of the highway at once with the node index of the graph
+    nodes = nearest_nodes(get_node_index(graph), coordinates[:, 0], coordinates[:, 1]).tolist()
+    positions = get_adjacency(graph).positions
+    match_index = get_match_index(graph)
+
+    edges = []
+    unmatched = []
+    for i in range(len(nodes)-1):
+        path = match_segment(match_index, positions[nodes[i]], positions[nodes[i+1]])
+        if path is None:
+            unmatched.append(i)
+        else:
+            edges += path
+
+    return way_id, Highway(description, edges, coordinates, unmatched)
+
+
+def build_match_index(graph):
+    '''
+    Auxiliar method of build_highways
+    Returns the graph prepared for the matching of the highways (MatchIndex)
+    Arguments:
+        graph -> graph of the streets
+    Complexity:
+        O(n + m log m) where n and m are the number of nodes and edges
+    '''
+
+    arrays = get_graph_arrays(graph)
+    reverse_indptr, reverse_indices, reverse_edges = reverse_arrays(arrays)
+    # equirectangular projection, as in the node index
+    x_scale = get_node_index(graph).x_scale
+    return MatchIndex(arrays.indptr.tolist(), arrays.indices.tolist(),
+                      reverse_indptr.tolist(), reverse_indices.tolist(), reverse_edges.tolist(),
+                      np.asarray(arrays.length).tolist(),
+                      (np.asarray(arrays.x) * x_scale * METERS_PER_DEGREE).tolist(),
+                      (np.asarray(arrays.y) * METERS_PER_DEGREE).tolist())
+
+
+def get_match_index(graph):
+    '''
+    Returns the match index of a graph, building it only the first time
+    (it is stored in the attributes of the graph, so it is shared by all its igraphs)
+    Arguments:
+        graph -> graph of the streets
+    Complexity:
+        O(1) if already built, otherwise same as build_match_index
+    '''
+
+    graph = base_graph(graph)
+    if 'match_index' not in graph.graph:
+        graph.graph['match_index'] = build_match_index(graph)
+    return graph.graph['match_index']
+
+
+def match_segment(match_index, source, target, radius=MATCH_RADIUS):
+    '''
+    Auxiliar method of build_highway
+    Returns the edge_ids of the shortest path (in meters) between the nodes of the ends of a segment of a highway,
+    or None if there is no path close to the segment
+    It is a bidirectional Dijkstra search that only visits the nodes whose distances to both ends
+    add up to at most the length of the segment plus twice the radius (an ellipse around the segment)
+    Arguments:
+        match_index -> graph prepared for the matching (MatchIndex)
+        source, target -> positions of the nodes of the ends of the segment (ints)
+        radius -> meters the path can go farther than the segment (float)
+    Complexity:
+        O(k log k) where k is the number of nodes inside the ellipse
+    '''
+
+    if source == target:
+        return []
+
+    x, y, length = match_index.x, match_index.y, match_index.length
+    sx, sy, tx, ty = x[source], y[source], x[target], y[target]
+    limit = math.hypot(sx - tx, sy - ty) + 2 * radius
+
+    # the forward search goes from the source and the backward one from the target;
+    # parent keeps the node and the edge each node was reached from
+    adjacency = ((match_index.indptr, match_index.indices, None),
+                 (match_index.reverse_indptr, match_index.reverse_indices, match_index.reverse_edges))
+    dist = ({source: 0.0}, {target: 0.0})
+    parent = ({source: None}, {target: None})
+    done = (set(), set())
+    queues = ([(0.0, source)], [(0.0, target)])
+    best = math.inf
+    meeting = None
+    while queues[0] and queues[1]:
+        # no shorter path can be found once the searches are farther than the best one
+        if queues[0][0][0] + queues[1][0][0] >= best:
+            break
+        side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+        d, u = heapq.heappop(queues[side])
+        if u in done[side]:
+            continue
+        done[side].add(u)
+
+        indptr, indices, edges = adjacency[side]
+        for e in range(indptr[u], indptr[u+1]):
+            v = indices[e]
+            edge = e if edges is None else edges[e]
+            nd = d + length[edge]
+            if nd >= dist[side].get(v, math.inf):
+                continue
+            if math.hypot(x[v] - sx, y[v] - sy) + math.hypot(x[v] - tx, y[v] - ty) > limit:
+                continue
+            dist[side][v] = nd
+            parent[side][v] = (u, edge)
+            heapq.heappush(queues[side], (nd, v))
+            if v in dist[1 - side] and nd + dist[1 - side][v] < best:
+                best = nd + dist[1 - side][v]
+                meeting = v
+
+    if meeting is None:
+        return None
+
+    # the edges from the source to the meeting node, and from it to the target
+    path = []
+    u = meeting
+    while parent[0][u] is not None:
+        u, edge = parent[0][u]
+        path.append(edge)
+    path.reverse()
+    u = meeting
+    while parent[1][u] is not None:
+        u, edge = parent[1][u]
+        path.append(edge)
+    return path
+
+
+# graph of the city in each of the processes of build_highways
+worker_graph = None
+
+
+def init_highways_worker(graph):
+    '''
+    Auxiliar method of build_highways
+    Stores the graph in the process, so that it is not sent with every line
+    Arguments:
+        graph -> graph of the city
+    Complexity:
+        O(1)
+    '''
+
+    global worker_graph
+    worker_graph = graph
+
+
+def build_highway_in_worker(line):
+    '''
+    Auxiliar method of build_highways
+    Same as build_highway, with the graph of the process
+    Arguments:
+        line -> fields of the line (vector of strings)
+    Complexity:
+        same as build_highway
+    '''
+
+    return build_highway(line, worker_graph)
+
+
+def my_nearest_node(graph, x, y):
+    '''
+    Returns the closest node of a graph to a point
+    Arguments:
+        graph -> graph of the streets
+        x, y -> coordinates of the point
+    Complexity:
+        O(log n) where n is the number of nodes in the graph
+        (plus O(n log n) the first time, to build the node index)
+    '''
+
+    return nearest_nodes(get_node_index(graph), [x], [y]).tolist()[0]
+
+
+def build_node_index(graph):
+    '''
+    Returns a spatial index (KD-tree) of the nodes of a graph
+    The coordinates are projected with an equirectangular projection
+    so that distances in both axes are comparable
+    Arguments:
+        graph -> graph of the streets
+    Complexity:
+        O(n log n) where n is the number of nodes in the graph
+    '''
+
+    nodes = np.array(list(graph.nodes))
+    coordinates = np.array([(info['x'], info['y']) for node, info in graph.nodes.items()], dtype=float)
+
+    # a degree of longitude is shorter than a degree of latitude by a factor cos(latitude)
+    x_scale = np.cos(np.radians(coordinates[:, 1].mean())) if len(coordinates) > 0 else 1.0
+    coordinates[:, 0] *= x_scale
+
+    # scikit-learn takes more than a second to import, so it is only imported when an index is built
+    from sklearn.neighbors import KDTree
+    return NodeIndex(nodes, KDTree(coordinates), x_scale)
+
+
+def get_node_index(graph):
+    '''
+    Returns the node index of a graph, building it only the first time
+    (it is stored in the attributes of the graph, so it is shared by all its igraphs)
+    Arguments:
+        graph -> graph of the streets
+    Complexity:
+        O(1) if already built, otherwise same as build_node_index
+    '''
+
+    graph = base_graph(graph)
+    if 'node_index' not in graph.graph:
+        graph.graph['node_index'] = build_node_index(graph)
+    return graph.graph['node_index']
+
+
+def nearest_nodes(node_index, xs, ys, k=1):
+    '''
+    Returns the k closest nodes to each of the points
+        (a vector of nodes if k is 1, a matrix with k columns otherwise)
+    Arguments:
+        node_index -> index of the nodes of a graph (NodeIndex)
+        xs, ys -> coordinates of the points (vectors of floats)
+        k -> number of neighbours of each point (int)
+    Complexity:
+        O(p * k log n) where p is the number of points and n the number of nodes
+    '''
+
+    points = np.column_stack((np.asarray(xs, dtype=float) * node_index.x_scale,
+                              np.asarray(ys, dtype=float)))
+    if len(points) == 0:
+        return node_index.nodes[:0]
+
+    positions = node_index.tree.query(points, k=k, return_distance=False)
+    if k == 1:
+        return node_index.nodes[positions[:, 0]]
+    return node_index.nodes[positions]
+
+
+def get_nice_coordinates(coordinates):
+    '''
+    Auxiliar method of download_and_build_highways
+    Returns the coordinates in the desired format: an array with a row (longitude, latitude) for each point
+    Arguments:
+        coordinates -> string with the coordinates (string)
+    Complexity:
+        O(n) where n is the number of coordinates
+    '''
+
+    return np.array(coordinates.split(','), dtype=float).reshape(-1, 2)
+
+
+@timed()
+def download_congestions(CONGESTIONS_URL):
+    '''
+    Returns the congestions of a city from the web (or from a local file)
+    Arguments:
+        CONGESTIONS_URL -> url or filename where the congestions are (string)
+    Complexity:
+        O(n) where n is the number of congestions
+    '''
+
+    count('congestion_downloads')
+    return list(stream_congestions(CONGESTIONS_URL))
+
+
+def stream_congestions(source):
+    '''
+    Returns an iterator over the congestions of a url or a local file,
+    which reads them as they are needed
+    Arguments:
+        source -> url or filename where the congestions are (string)
+    Complexity:
+        O(1) for each congestion
+    '''
+
+    return iter_congestions(open_lines(source))
+
+
+@timed()
+def download_congestions_if_modified(CONGESTIONS_URL, validators=None):
+    '''
+    Returns the congestions of a city from the web and the validators of the response
+    (its ETag and Last-Modified headers), or None and the same validators if the congestions
+    have not changed since the response of the validators (the server answers 304 without sending them)
+    Arguments:
+        CONGESTIONS_URL -> url where the congestions are (string, link)
+        validators -> validators of the previous response (dictionary) or None
+    Complexity:
+        O(1) if the congestions have not changed, otherwise O(n) where n is the number of congestions
+    '''
+
+    request = urllib.request.Request(CONGESTIONS_URL)
+    if validators is not None:
+        if validators['etag'] is not None:
+            request.add_header('If-None-Match', validators['etag'])
+        if validators['last_modified'] is not None:
+            request.add_header('If-Modified-Since', validators['last_modified'])
+
+    try:
+        with urllib.request.urlopen(request) as response:
+            congestions = list(iter_congestions(io.TextIOWrapper(response, encoding='utf-8', newline='')))
+            new_validators = {'etag': response.headers.get('ETag'),
+                              'last_modified': response.headers.get('Last-Modified')}
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            count('congestion_downloads_not_modified')
+            return None, validators
+        raise
+
+    count('congestion_downloads')
+    return congestions, new_validators
+
+
+def iter_congestions(lines):
+    '''
+    Auxiliar method of download_congestions
+    Returns an iterator over the congestions of the lines of the congestions csv
+    Arguments:
+        lines -> lines of the congestions csv (iterable of strings)
+    Complexity:
+        O(1) for each congestion
+    '''
+
+    # read them one at a time
+    reader = csv.reader(lines, delimiter='#')
+
+    for line in reader:
+        way_id, date, current, predicted = line
+        way_id = int(way_id)
+        current = int(current)
+        predicted = int(predicted)
+        yield Congestion(way_id, current, predicted)
+
+
+class CachedStaticMap(StaticMap):
+    '''
+    StaticMap that keeps the tiles of the base map in a directory,
+    so that each tile is downloaded only once
+    '''
+
+    def __init__(self, width, height, tiles_directory=TILES_DIRECTORY, **kwargs):
+        super().__init__(width, height, **kwargs)
+        self.tiles_directory = tiles_directory
+
+    def get(self, url, **kwargs):
+        '''
+        Returns the status code and content (in bytes) of the requested tile url,
+        reading it from the directory if it has already been downloaded
+        Complexity:
+            O(1) if the tile is in the directory, otherwise same as StaticMap.get
+        '''
+
+        filename = os.path.join(self.tiles_directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.png')
+        try:
+            with open(filename, 'rb') as file:
+                return 200, file.read()
+        except FileNotFoundError:
+            pass
+
+        status_code, content = super().get(url, **kwargs)
+        if status_code == 200:
+            # tiles are downloaded by several threads, write each one atomically
+            os.makedirs(self.tiles_directory, exist_ok=True)
+            temporary = filename + '.' + str(threading.get_ident())
+            with open(temporary, 'wb') as file:
+                file.write(content)
+            os.replace(temporary, filename)
+        return status_code, content
+
+
+def plot_congestions(highways, congestions, CONGESTIONS_FILENAME, SIZE):
+    '''
+    Get a map with the congestions plotted
+    Arguments:
+        highways -> streets whose congestions we know (HighwayStore)
+        congestions -> congestions of those streets (vector of congestions)
+        CONGESTIONS_FILENAME -> filename where the map has to be stored (string ended in ".png")
+        SIZE -> size of the map (int)
+    Complexity:
+        same as render_congestions
+    '''
+
+    with open(CONGESTIONS_FILENAME, 'wb') as file:
+        file.write(render_congestions(highways, congestions, SIZE))
+
+
+@timed()
+def render_congestions(highways, congestions, SIZE):
+    '''
+    Auxiliar method of plot_congestions
+    Returns the png image (bytes) of the map with the congestions plotted,
+    rendering it only the first time for each congestion snapshot
+    (concurrent requests for the same snapshot wait for a single render, the other ones do not wait)
+    Arguments:
+        highways -> streets whose congestions we know (HighwayStore)
+        congestions -> congestions of those streets (vector of congestions)
+        SIZE -> size of the map (int)
+    Complexity:
+        O(n + k) where n is the number of congestions and k the number of coordinates of the highways
+        (plus the render and the tiles that are not in the tiles directory the first time)
+    '''
+
+    key = (highways_digest(highways), SIZE, tuple((c.way_id, c.current) for c in congestions))
+    # the lock only guards the cache: each image is a future, rendered without the lock by the first
+    # request for its snapshot, that the concurrent requests for the same snapshot wait for
+    with congestion_images_lock:
+        image = congestion_images.get(key)
+        if image is not None:
+            count('congestion_image_hits')
+            congestion_images.move_to_end(key)
+            rendered = True
+        else:
+            count('congestion_image_misses')
+            image = congestion_images[key] = concurrent.futures.Future()
+            rendered = False
+            while len(congestion_images) > CONGESTION_IMAGES:
+                congestion_images.popitem(last=False)
+    if rendered:
+        return image.result()
+
+    try:
+        # each type of congestion has a different color to be plotted with
+        congestion_colors = ["gray", "green", "palegreen", "yellow", "orange", "red", "black"]
+        m = CachedStaticMap(SIZE, SIZE)
+        for c in congestions:
+            if c.way_id not in highways.rows:
+                continue
+            # each highway is plotted as a single line through all its coordinates
+            coordinates = highway_coordinates(highways, c.way_id)
+            if len(coordinates) > 1:
+                m.add_line(Line(coordinates, congestion_colors[c.current], 2))
+        image.set_result(map_to_png(m))
+    except Exception as e:
+        # the failed render is not kept, so the next request tries again
+        with congestion_images_lock:
+            if congestion_images.get(key) is image:
+                del congestion_images[key]
+        image.set_exception(e)
+    return image.result()
+
+
+def highways_digest(highways):
+    '''
+    Auxiliar method of render_congestions
+    Returns a hash of the ids and coordinates of the highways, that identifies them
+    even after they are loaded again
+    Arguments:
+        highways -> streets whose congestions we know (HighwayStore)
+    Complexity:
+        O(h + k) where h is the number of highways and k the number of their coordinates
+    '''
+
+    digest = hashlib.sha256()
+    for column in (highways.way_ids, highways.coordinate_offsets, highways.coordinates):
+        digest.update(np.ascontiguousarray(column).tobytes())
+    return digest.hexdigest()
+
+
+# rendered maps of the last congestion snapshots (futures of their png images),
+# from the least to the most recently used
+congestion_images = collections.OrderedDict()
+congestion_images_lock = threading.Lock()
+
+
+@timed()
+def build_igraph(graph, highways, congestions, context=None, chat_id=None, message_id=None):
+    '''
+    Returns the igraph (graph with the congestion and itime of its edges, current and predicted)
+    The congestion and itime are arrays indexed by the 'edge_id' of each edge (see get_edge_table),
+    stored together with a version that identifies the congestion snapshot in a weight layer
+    on top of the graph (see weight_layer), so the graph itself is not changed
+    (optional) It also tells the Telegram user when it has been loaded, changing the last message the bot sent
+    Arguments:
+        graph -> graph of the streets
+        highways -> streets whose congestions we know (HighwayStore)
+        congestions -> congestions of those streets (vector of congestions)
+        Optionals:
+        context -> context of the telegram bot
+        chat_id -> id of the chat with the user (int)
+        message_id -> id of the last message of our bot (int)
+    Complexity:
+        O(m + c + e) where
+            m is the number of edges in the graph
+            c is the number of congestions
+            e is the number of edges of the highways with congestion (vectorized)
+        (plus same as build_edge_table the first time)
+    '''
+
+    # the static attributes (maxspeed, time) are only computed once per graph
+    table = get_edge_table(graph)
+    congestion = np.zeros(len(table.edges), dtype=np.int8)
+    predicted = np.zeros(len(table.edges), dtype=np.int8)
+
+    # the congestion value of the edges of all the highways is changed at once
+    ids, counts = gather_highway_edges(highways, [c.way_id for c in congestions])
+    congestion[ids] = np.repeat([c.current for c in congestions], counts)
+    predicted[ids] = np.repeat([c.predicted for c in congestions], counts)
+
+    if context is not None:
+        context.bot.editMessageText(chat_id=chat_id,
+                                    message_id=message_id,
+                                    text="100%, graph updated")
+
+    # finally we compute the itime of all the edges at once
+    # (and the one with the predicted congestion, used by the time dependent routing)
+    count('igraph_builds')
+    return weight_layer(graph, {'congestion': congestion,
+                                'itime': compute_itime(table, congestion),
+                                'predicted': predicted,
+                                'predicted_itime': compute_itime(table, predicted),
+                                'version': next(igraph_versions)})
+
+
+@timed()
+def update_igraph(igraph, highways, old_congestions, new_congestions):
+    '''
+    Returns a new igraph updated from one congestion snapshot to another, equal to the one build_igraph
+    would build with the new snapshot, recomputing the congestion and itime only on the edges of the highways
+    whose current (or predicted) state changed, or that appeared or disappeared
+    Each of those edges takes again the value of the last highway of the snapshot that covers it (as in build_igraph),
+    found with the index of the highways that cover each edge (covered_edges and covering_rows of the store),
+    so edges shared by several highways keep the value of the ones that did not change
+    If the highways of both snapshots are in a different order, or more than UPDATE_FRACTION of them changed,
+    the igraph is built again with build_igraph
+    The old igraph is not changed, so routes computed with it meanwhile see the old snapshot:
+    the arrays that change are copied and the ones that do not are shared by both igraphs
+    Arguments:
+        igraph -> igraph built with old_congestions
+        highways -> streets whose congestions we know (HighwayStore)
+        old_congestions -> congestions the igraph was built with (vector of congestions)
+        new_congestions -> new congestions of those streets (vector of congestions)
+    Complexity:
+        O(c + t log e) where
+            c is the number of congestions
+            t is the number of edges of the highways that changed (and of the highways that share them)
+            e is the number of edges of all the highways
+        plus a copy of the arrays that change (a single memcpy of m values, where m is the number of edges)
+    '''
+
+    # the value of an edge shared by several highways depends on their order in the snapshot
+    if not same_order(old_congestions, new_congestions):
+        return build_igraph(igraph, highways, new_congestions)
+    # and when most of the highways change, building it again is faster
+    states = (('current', 'congestion', 'itime'), ('predicted', 'predicted', 'predicted_itime'))
+    changes = [diff_congestions(old_congestions, new_congestions, state) for state, _, _ in states]
+    if max(len(changed) for changed in changes) > UPDATE_FRACTION * max(len(new_congestions), 1):
+        return build_igraph(igraph, highways, new_congestions)
+
+    table = get_edge_table(igraph)
+    weights = {'version': next(igraph_versions)}
+    # position in the new snapshot of the last congestion of each highway of the store (-1 if it has none)
+    positions = np.full(len(highways.way_ids), -1, dtype=np.int64)
+    for i, c in enumerate(new_congestions):
+        row = highways.rows.get(c.way_id)
+        if row is not None:
+            positions[row] = i
+
+    for (state, congestion_key, itime_key), changed in zip(states, changes):
+        # the edges of the highways that changed (sorted without repetitions, sorting is faster than np.unique for these sizes)
+        touched = np.sort(gather_highway_edges(highways, list(changed.keys()))[0])
+        touched = touched[np.append(True, touched[1:] != touched[:-1])] if len(touched) else touched
+        if len(touched) == 0:
+            weights[congestion_key] = igraph.graph[congestion_key]
+            weights[itime_key] = igraph.graph[itime_key]
+            continue
+
+        values = np.array([getattr(c, state) for c in new_congestions], dtype=np.int8)
+        congestion = igraph.graph[congestion_key].copy()
+        congestion[touched] = last_congestions(highways, touched, positions, values)
+        itime = igraph.graph[itime_key].copy()
+        itime[touched] = table.time[touched] * MULTIPLIERS[congestion[touched]]
+
+        weights[congestion_key] = congestion
+        weights[itime_key] = itime
+    count('igraph_updates')
+    return weight_layer(igraph, weights)
+
+
+def last_congestions(highways, edges, positions, values):
+    '''
+    Auxiliar method of update_igraph
+    Returns the congestion of some edges: the one of the last highway of the snapshot that covers each of them
+    (0 if none of the highways that cover it is in the snapshot)
+    Arguments:
+        highways -> streets whose congestions we know (HighwayStore)
+        edges -> edge_ids of edges covered by some highway, without repetitions (array)
+        positions -> position in the snapshot of each highway of the store, -1 if it is not there (array)
+        values -> congestion of each position of the snapshot (array)
+    Complexity:
+        O(t log e) where t is the number of times the edges are covered and e the number of edges of all the highways
+    '''
+
+    # the highways that cover each edge are a range of the sorted index, all of them are gathered at once
+    starts = np.searchsorted(highways.covered_edges, edges, side='left')
+    counts = np.searchsorted(highways.covered_edges, edges, side='right') - starts
+    offsets = np.cumsum(counts) - counts
+    covering = np.arange(counts.sum()) + np.repeat(starts - offsets, counts)
+
+    # the last highway wins, as in build_igraph (position -1 takes the 0 appended at the end)
+    last = np.maximum.reduceat(positions[highways.covering_rows[covering]], offsets)
+    return np.append(values, 0).astype(np.int8)[last]
+
+
+def diff_congestions(old_congestions, new_congestions, state='current'):
+    '''
+    Auxiliar method of update_igraph
+    Returns a dictionary with the new state of the highways that changed
+    (highways that no longer appear go back to state 0, and the ones that appear are always included,
+    even with state 0, because they can cover edges of other highways)
+    Arguments:
+        old_congestions -> previous congestions (vector of congestions)
+        new_congestions -> new congestions (vector of congestions)
+        state -> state that is compared ('current' or 'predicted')
+    Complexity:
+        O(c) where c is the number of congestions
+    '''
+
+    old_state = {c.way_id: getattr(c, state) for c in old_congestions}
+    new_state = {c.way_id: getattr(c, state) for c in new_congestions}
+
+    changed = {way_id: 0 for way_id in old_state if way_id not in new_state}
+    for way_id, value in new_state.items():
+        if way_id not in old_state or old_state[way_id] != value:
+            changed[way_id] = value
+    return changed
+
+
+def same_order(old_congestions, new_congestions):
+    '''
+    Auxiliar method of update_igraph
+    Returns whether the highways that are in both snapshots are in the same order in both
+    Arguments:
+        old_congestions -> previous congestions (vector of congestions)
+        new_congestions -> new congestions (vector of congestions)
+    Complexity:
+        O(c) where c is the number of congestions
+    '''
+
+    old_ids = {c.way_id for c in old_congestions}
+    new_ids = {c.way_id for c in new_congestions}
+    return ([c.way_id for c in old_congestions if c.way_id in new_ids] ==
+            [c.way_id for c in new_congestions if c.way_id in old_ids])
+
+
+# versions of the congestion snapshots of the igraphs, increasing
+igraph_versions = itertools.count()
+
+
+def weight_layer(graph, weights):
+    '''
+    Returns an igraph: a read-only view of the graph of the streets (its nodes and edges are not copied)
+    whose attributes are the given weights on top of the attributes of the graph
+    Arguments:
+        graph -> graph of the streets (or another igraph, whose weights are not inherited)
+        weights -> congestion, itime, predicted, predicted_itime and version of the igraph (dict)
+    Complexity:
+        O(1)
+    '''
+
+    base = base_graph(graph)
+    igraph = networkx.graphviews.generic_graph_view(base)
+    igraph.graph = collections.ChainMap(dict(weights, base=base), base.graph)
+    return igraph
+
+
+def base_graph(graph):
+    '''
+    Returns the graph of the streets an igraph is a view of (or the graph itself if it is not an igraph)
+    The things built only once per graph (edge table, node index, landmarks...) are stored in it,
+    so they are shared by all the igraphs
+    Arguments:
+        graph -> graph of the streets or igraph
+    Complexity:
+        O(1)
+    '''
+
+    return graph.graph.get('base', graph)
+
+
+def build_edge_table(graph):
+    '''
+    Auxiliar method of build_igraph
+    Returns the edge table of the graph (length, maxspeed and time of all edges)
+    and gives each edge of the graph its 'edge_id' (position in the table)
+    Arguments:
+        graph -> graph of the streets
+    Complexity:
+        O(m) where m is the number of edges in the graph
+    '''
+
+    edges = list(graph.edges)
+    length = np.empty(len(edges))
+    maxspeed = np.empty(len(edges))
+    for i, (edge, info) in enumerate(graph.edges.items()):
+        info['edge_id'] = i
+        length[i] = info['length']
+        maxspeed[i] = edge_maxspeed(info)
+
+    return EdgeTable(edges, length, maxspeed, length / maxspeed)
+
+
+def get_edge_table(graph):
+    '''
+    Returns the edge table of a graph, building it only the first time
+    (it is stored in the attributes of the graph, so it is shared by all its igraphs)
+    Arguments:
+        graph -> graph of the streets
+    Complexity:
+        O(1) if already built, otherwise same as build_edge_table
+    '''
 
-# Each highway has a vector of all the edges of the graph it goes through and its coordinates
-Highway = collections.namedtuple('Highway', 'description, edges, coordinates')
-Congestion = collections.namedtuple('Congestion', 'way_id, current, predicted')
+    graph = base_graph(graph)
+    if 'edge_table' not in graph.graph:
+        graph.graph['edge_table'] = build_edge_table(graph)
+    return graph.graph['edge_table']
 
 
-def get_graph(GRAPH_FILENAME, PLACE):
+def edge_maxspeed(info):
     '''
-    Returns the digraph of the streets of a city
-        getting it from a file if it has already been stored there
-        storing it in the file otherwise
+    Auxiliar method of build_edge_table
+    Returns the maxspeed of an edge (float), guessing it from
+    the type of road when the edge does not have one
     Arguments:
-        GRAPH_FILENAME -> filename of the graph (string ended in ".graph")
-        PLACE -> name of the city (string)
+        info -> attributes of the edge (dict)
     Complexity:
-        if graph alrady in file -> same as pickle.load
-        otherwise -> same as osmnx.graph_from_place
+        O(1)
     '''
 
-    try:
-        # if it is already loaded in the file, simply return it
-        with open(GRAPH_FILENAME, 'rb') as file:
-            return pickle.load(file)
-
-    except Exception as e:
-        # otherwise download it
-        multi_graph = osmnx.graph_from_place(PLACE, network_type='drive', simplify=True)
-        graph = osmnx.get_digraph(multi_graph, weight='length')
+    if 'maxspeed' in info:
+        if isinstance(info['maxspeed'], list):
+            return max(float(speed) for speed in info['maxspeed'])
+        return float(info['maxspeed'])
+
+    highway = info['highway']
+    # if highway of the edge is a list, take the most relevant element
+    if isinstance(highway, list):
+        if 'residential' in highway:
+            highway = 'residential'
+        elif 'secondary' in highway or 'primary' in highway or 'primary_link' in highway:
+            highway = 'primary'
+        elif 'tertiary' in highway:
+            highway = 'residential'
+        elif 'living_street' in highway:
+            highway = 'living_street'
+        elif 'unclassified' in highway:
+            highway = 'unclassified'
+
+    # set a maxspeed for the edge depending on the type of road ("highway") it is
+    if highway == 'trunk_link':
+        return 60.0
+    elif highway == 'secondary' or highway == 'primary' or highway == 'primary_link':
+        return 50.0
+    elif highway == 'residential' or highway == 'tertiary':
+        return 30.0
+    elif highway == 'living_street':
+        return 20.0
+    elif highway == 'unclassified':
+        return 10.0
+    raise KeyError('maxspeed')
+
+
+def compute_itime(table, congestion):
+    '''
+    Auxiliar method of build_igraph
+    Returns the itime of all edges (array indexed by edge_id)
+    Arguments:
+        table -> edge table of the graph (EdgeTable)
+        congestion -> congestion of all edges (array indexed by edge_id)
+    Complexity:
+        O(m) where m is the number of edges in the graph (vectorized)
+    '''
 
-        # and store it into the file before returning it
-        with open(GRAPH_FILENAME, 'wb') as file2:
-            pickle.dump(graph, file2)
-        return graph
+    return table.time * MULTIPLIERS[congestion]
 
 
-def download_and_build_highways(HIGHWAYS_URL, graph):
+def get_graph_arrays(graph):
     '''
-    Returns the highways of a city from the web
+    Returns the arrays of a graph (the ones it was loaded from, or new ones the first time)
     Arguments:
-        HIGHWAYS_URL -> url where the highways are (string, link)
-        graph -> graph of the city
+        graph -> graph of the streets
     Complexity:
-        O(n) where n is the number of highways
+        O(1) if already built, otherwise same as graph_to_arrays
     '''
 
-    with urllib.request.urlopen(HIGHWAYS_URL) as response:
-        # put all the lines of the webpage in a vector
-        lines = [line.decode('utf-8') for line in response.readlines()]
+    graph = base_graph(graph)
+    if 'arrays' not in graph.graph:
+        graph.graph['arrays'] = graph_to_arrays(graph)
+    return graph.graph['arrays']
 
-        # read them and store them in a vector
-        reader = csv.reader(lines, delimiter=',', quotechar='"')
-        next(reader)    # ignore first line with description
 
-        highways = []
-        for line in reader:
-            way_id, description, coordinates = line
-            way_id = int(way_id)
-            # change the format of coordinates for an easier use
-            coordinates = get_nice_coordinates(coordinates)
+def get_adjacency(graph):
+    '''
+    Returns the adjacency of a graph as lists, building it only the first time
+    Arguments:
+        graph -> graph of the streets
+    Complexity:
+        O(1) if already built, otherwise O(n + m) where n and m are the number of nodes and edges
+    '''
 
-            nodes = []
-            for coord in coordinates:
-                # we build a function to get the nearest node to a points in a digraph
-                # otherwise it would be way too slow
-                nodes.append(my_nearest_node(graph, coord[0], coord[1]))
+    graph = base_graph(graph)
+    if 'adjacency' not in graph.graph:
+        arrays = get_graph_arrays(graph)
+        positions = {node: i for i, node in enumerate(arrays.nodes.tolist())}
+        graph.graph['adjacency'] = Adjacency(positions, arrays.indptr.tolist(), arrays.indices.tolist())
+    return graph.graph['adjacency']
 
-            edges = []
-            for i in range(len(nodes)-1):
-                try:
-                    path = osmnx.shortest_path(graph, nodes[i], nodes[i+1])
-                except Exception as e:
-                    continue
 
-                if path is not None:
-                    for j in range(len(path)-1):
-                        edges.append((path[j], path[j+1]))
+def reverse_arrays(arrays):
+    '''
+    Auxiliar method of build_landmarks
+    Returns the adjacency of the reversed graph in CSR format
+    together with the edge_id of each of its edges
+    Arguments:
+        arrays -> arrays of the graph (GraphArrays)
+    Complexity:
+        O(m log m) where m is the number of edges
+    '''
 
-            while(len(highways) <= way_id):
-                highways.append(Highway(0, 0, 0))
+    sources = np.repeat(np.arange(len(arrays.nodes)), np.diff(arrays.indptr))
+    edge_ids = np.argsort(arrays.indices, kind='stable')
+    indptr = np.zeros(len(arrays.nodes) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(arrays.indices, minlength=len(arrays.nodes)))
+    return indptr, sources[edge_ids], edge_ids
 
-            # the position of each highway in the vector is its id (to locate its congestion later)
-            highways[way_id] = Highway(description, edges, coordinates)
 
-        return highways
+def csr_dijkstra(indptr, indices, edge_ids, weights, source):
+    '''
+    Auxiliar method of build_landmarks
+    Returns the distance from a node to all the nodes of a graph in CSR format (inf if unreachable)
+    Arguments:
+        indptr, indices -> adjacency of the graph in CSR format (arrays)
+        edge_ids -> edge_id of each edge of the adjacency (array)
+        weights -> weight of the edges (array indexed by edge_id)
+        source -> position of the node (int)
+    Complexity:
+        O(m log n) where n and m are the number of nodes and edges
+    '''
 
+    indptr = indptr.tolist()
+    indices = indices.tolist()
+    weights = np.asarray(weights)[edge_ids].tolist()
+
+    dist = [math.inf] * (len(indptr) - 1)
+    dist[source] = 0.0
+    queue = [(0.0, source)]
+    while queue:
+        d, u = heapq.heappop(queue)
+        if d > dist[u]:
+            continue
+        for e in range(indptr[u], indptr[u+1]):
+            v = indices[e]
+            if d + weights[e] < dist[v]:
+                dist[v] = d + weights[e]
+                heapq.heappush(queue, (dist[v], v))
+    return np.array(dist)
+
+
+@timed()
+def build_landmarks(graph, count=8):
+    '''
+    Returns the preprocessing of the ALT routing of a graph
+    The landmarks are chosen one by one as the node farthest from the ones already chosen,
+    and the distances are computed with the time without congestion, which is a lower bound
+    of the itime of any congestion (all multipliers are at least 1), so it never has to be recomputed
+    Arguments:
+        graph -> graph of the streets
+        count -> number of landmarks (int)
+    Complexity:
+        O(count * m log n) where n and m are the number of nodes and edges
+    '''
 
-def my_nearest_node(graph, x, y):
+    arrays = get_graph_arrays(graph)
+    time = get_edge_table(graph).time * MULTIPLIERS.min()
+    reverse = reverse_arrays(arrays)
+    forward_edge_ids = np.arange(len(arrays.indices))
+
+    landmarks = []
+    from_landmark = []
+    to_landmark = []
+    # the first landmark is the farthest node from an arbitrary one
+    closeness = csr_dijkstra(arrays.indptr, arrays.indices, forward_edge_ids, time, 0)
+    for i in range(min(count, len(arrays.nodes))):
+        reachable = np.where(np.isfinite(closeness), closeness, -1)
+        landmark = int(np.argmax(reachable))
+        landmarks.append(landmark)
+        from_landmark.append(csr_dijkstra(arrays.indptr, arrays.indices, forward_edge_ids, time, landmark))
+        to_landmark.append(csr_dijkstra(*reverse, time, landmark))
+
+        # the next one is the node whose closest landmark is the farthest
+        distances = np.fmin(from_landmark[-1], to_landmark[-1])
+        closeness = distances if i == 0 else np.fmin(closeness, distances)
+        closeness[landmarks] = -1
+
+    # lists are stored instead of arrays because queries read them one element at a time
+    return Landmarks(landmarks, np.array(from_landmark).T.tolist(), np.array(to_landmark).T.tolist())
+
+
+def get_landmarks(graph):
     '''
-    Auxiliar method of download_and_build_highways
-    Returns the closest node of a graph to a point
+    Returns the preprocessing of the ALT routing of a graph, building it only the first time
     Arguments:
         graph -> graph of the streets
-        x, y -> coordinates of the point
     Complexity:
-        O(n) where n is the number of nodes in the graph
+        O(1) if already built, otherwise same as build_landmarks
     '''
 
-    best_node = None
-    best_dist = 1e10
-    for node, info in graph.nodes.items():
-        this_dist = (x-info['x'])**2 + (y-info['y'])**2
-        if this_dist < best_dist:
-            best_dist = this_dist
-            best_node = node
-    return best_node
+    graph = base_graph(graph)
+    if 'landmarks' not in graph.graph:
+        graph.graph['landmarks'] = build_landmarks(graph)
+    return graph.graph['landmarks']
 
 
-def get_nice_coordinates(coordinates):
+@timed()
+def alt_shortest_path(igraph, begin, end):
     '''
-    Auxiliar method of download_and_build_highways
-    Returns a vector of the coordinates in the desired format
+    Returns the nodes of the fastest path (with itime) between two nodes,
+    using A* with the lower bounds given by the landmarks and the triangle inequality
+    Raises networkx.NetworkXNoPath if there is no path
     Arguments:
-        coordinates -> string with the coordinates (string)
+        igraph -> igraph of the streets of the city
+        begin, end -> nodes of the origin and destination
     Complexity:
-        O(n) where n is the number of coordinates
+        same as alt_search
     '''
 
-    # get a vector with all the coordinates
-    coordinates = coordinates.split(',')
-    for i in range(len(coordinates)):
-        coordinates[i] = float(coordinates[i])
-
-    # group each pair of coordinates in a tuple
-    grouped_coordinates = []
-    for i in range(0, len(coordinates), 2):
-        grouped_coordinates.append((coordinates[i], coordinates[i+1]))
-
-    return grouped_coordinates
+    itime = igraph.graph['itime']
+    path, arrival = alt_search(igraph, begin, end, lambda e, t: t + float(itime[e]))
+    return path
 
 
-def download_congestions(CONGESTIONS_URL):
+@timed()
+def td_shortest_path(igraph, begin, end, horizon=PREDICTION_HORIZON):
     '''
-    Returns the congestions of a city from the web
+    Returns the nodes of the fastest path between two nodes and its duration in seconds,
+    where each edge is crossed with the current congestion until the horizon and with the predicted one after it
+    (an edge crossed at the horizon takes the current speed for the part before it and the predicted one after),
+    so arriving later to an edge never means leaving it earlier and the search gives the exact fastest path
+    Raises networkx.NetworkXNoPath if there is no path
     Arguments:
-        CONGESTIONS_URL -> url where the congestions are (string, link)
+        igraph -> igraph of the streets of the city
+        begin, end -> nodes of the origin and destination
+        horizon -> seconds after which the predicted congestion is used (float)
     Complexity:
-        O(n) where n is the number of congestions
+        same as alt_search
     '''
 
-    with urllib.request.urlopen(CONGESTIONS_URL) as response:
-        # put all the lines of the webpage in a vector
-        lines = [line.decode('utf-8') for line in response.readlines()]
+    itime = igraph.graph['itime']
+    predicted_itime = igraph.graph['predicted_itime']
+    horizon = horizon / SECONDS_PER_TIME
 
-        # read them and store them in a vector
-        reader = csv.reader(lines, delimiter='#')
+    def arrival(e, t):
+        current = float(itime[e])
+        if t + current <= horizon:
+            return t + current
+        # the part of the edge that is left at the horizon is crossed with the predicted congestion
+        left = 1.0 if t >= horizon else 1.0 - (horizon - t) / current
+        return max(t, horizon) + left * float(predicted_itime[e])
 
-        congestions = []
-        for line in reader:
-            way_id, date, current, predicted = line
-            way_id = int(way_id)
-            current = int(current)
-            predicted = int(predicted)
-            congestions.append(Congestion(way_id, current, predicted))
+    path, arrival_time = alt_search(igraph, begin, end, arrival)
+    return path, arrival_time * SECONDS_PER_TIME
 
-        return congestions
 
+def alt_search(igraph, begin, end, arrival):
+    '''
+    Auxiliar method of alt_shortest_path and td_shortest_path
+    Returns the nodes of the fastest path between two nodes and the time of arrival (in time units),
+    using A* with the lower bounds given by the landmarks and the triangle inequality
+    (valid for any arrival function that never takes less than the time without congestion)
+    Raises networkx.NetworkXNoPath if there is no path
+    Arguments:
+        igraph -> igraph of the streets of the city
+        begin, end -> nodes of the origin and destination
+        arrival -> function that returns the time of arrival at the end of an edge (its edge_id)
+            when entering it at a given time
+    Complexity:
+        O(m log n) in the worst case, where n and m are the number of nodes and edges,
+        but it usually visits only a small part of the graph
+    '''
 
-def plot_congestions(highways, congestions, CONGESTIONS_FILENAME, SIZE):
+    adjacency = get_adjacency(igraph)
+    landmarks = get_landmarks(igraph)
+    indptr = adjacency.indptr
+    indices = adjacency.indices
+    from_landmark = landmarks.from_landmark
+    to_landmark = landmarks.to_landmark
+    source = adjacency.positions[begin]
+    target = adjacency.positions[end]
+    from_target = from_landmark[target]
+    to_target = to_landmark[target]
+
+    def lower_bound(u):
+        # d(u, target) >= d(L, target) - d(L, u) and d(u, target) >= d(u, L) - d(target, L)
+        # (the comparisons are false for nan, when the landmark cannot reach either node)
+        best = 0.0
+        for d_target, d_u in zip(from_target, from_landmark[u]):
+            if d_target - d_u > best:
+                best = d_target - d_u
+        for d_u, d_target in zip(to_landmark[u], to_target):
+            if d_u - d_target > best:
+                best = d_u - d_target
+        return best
+
+    dist = {source: 0.0}
+    parent = {source: None}
+    done = set()
+    queue = [(lower_bound(source), source)]
+    while queue:
+        priority, u = heapq.heappop(queue)
+        if u == target:
+            break
+        if u in done:
+            continue
+        done.add(u)
+        for e in range(indptr[u], indptr[u+1]):
+            v = indices[e]
+            d = arrival(e, dist[u])
+            if v not in done and d < dist.get(v, math.inf):
+                dist[v] = d
+                parent[v] = u
+                heapq.heappush(queue, (d + lower_bound(v), v))
+    else:
+        raise networkx.NetworkXNoPath('No path between {} and {}'.format(begin, end))
+
+    return rebuild_path(igraph, parent, target), dist[target]
+
+
+def osmnx_geocoder(query, place='Barcelona'):
     '''
-    Get a map with the congestions plotted
+    Returns the coordinates (latitude, longitude) of a place of a city using osmnx
     Arguments:
-        highways -> streets whose congestions we know (vector of highway)
-        congestions -> congestions of those streets (vector of congestions)
-        CONGESTIONS_FILENAME -> filename where the map has to be stored (string ended in ".png")
-        SIZE -> size of the map (int)
+        query -> name of the place (string)
+        place -> city where the place is (string)
     Complexity:
-        O(n) where n is the number of congestions
+        same as osmnx.geocode
     '''
 
-    # each type of congestion has a different color to be plotted with
-    congestion_colors = ["gray", "green", "palegreen", "yellow", "orange", "red", "black"]
-    m = StaticMap(SIZE, SIZE)
-    for c in congestions:
-        for i in range(len(highways[c.way_id].coordinates)-1):
-            coord1 = highways[c.way_id].coordinates[i]
-            coord2 = highways[c.way_id].coordinates[i+1]
-            m.add_line(Line((coord1, coord2), congestion_colors[c.current], 2))
-    m.render().save(CONGESTIONS_FILENAME)
+    import osmnx
+    return osmnx.geocode(query + ", " + place)
 
 
-def build_igraph(graph, highways, congestions, context=None, chat_id=None, message_id=None):
+def new_geocode_cache(backend=osmnx_geocoder, capacity=1024, filename=None):
     '''
-    Returns the igraph (graph with itime in edges)
-    (optional) It also tells the Telegram user the % that has already been loaded, changing the last message the bot sent
+    Returns an empty geocode cache, or the one stored in the file if there is one
     Arguments:
-        graph -> graph of the streets
-        highways -> streets whose congestions we know (vector of highway)
-        congestions -> congestions of those streets (vector of congestions)
-        Optionals:
-        context -> context of the telegram bot
-        chat_id -> id of the chat with the user (int)
-        message_id -> id of the last message of our bot (int)
+        backend -> function that geocodes a query (function)
+        capacity -> maximum number of queries kept (int)
+        filename -> filename where the cache is stored (string ended in ".geocodes") or None
     Complexity:
-        O(m + n*c) where
-            m is the number of edges in the graph
-            n is the number of nodes in the graph
-            c is the number of congestions
+        O(1) if no file, otherwise same as pickle.load
+    '''
+
+    entries = collections.OrderedDict()
+    if filename is not None:
+        try:
+            with open(filename, 'rb') as file:
+                entries.update(pickle.load(file))
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            # a missing or truncated file is an empty cache
+            pass
+
+    while len(entries) > capacity:
+        entries.popitem(last=False)
+    return GeocodeCache(backend, entries, capacity, filename, threading.Lock())
+
+
+def normalize_query(query):
+    '''
+    Auxiliar method of geocode
+    Returns the query in lowercase without repeated spaces or punctuation at the ends,
+    so that different ways of writing the same place share the cache
+    Arguments:
+        query -> name of the place (string)
+    Complexity:
+        O(l) where l is the length of the query
     '''
 
-    # first we add maxspeed, time and congestion (with an initial value of 0) to all edges
-    graph = force_maxspeed(graph)
-    graph = add_time_and_0congestion(graph)
+    return ' '.join(query.lower().split()).strip(' .,;')
 
-    curr = 0
-    # and for each congestion we change the congestion value of its respective edges
-    for i in range(len(congestions)):
 
-        # if the option is active, show the percentage
-        if context is not None:
-            next = 7*(100*i//(len(congestions)*7))
-            if curr != next:
-                curr = next
-                context.bot.editMessageText(chat_id=chat_id,
-                                            message_id=message_id,
-                                            text=str(curr) + "%")
+def geocode(cache, query):
+    '''
+    Returns the coordinates (latitude, longitude) of a place,
+    asking the backend of the cache only if the query is not in the cache
+    (the least recently used query is forgotten when the cache is full)
+    Arguments:
+        cache -> geocode cache (GeocodeCache)
+        query -> name of the place (string)
+    Complexity:
+        O(1) if the query is in the cache, otherwise same as the backend
+    '''
+
+    key = normalize_query(query)
+    with cache.lock:
+        if key in cache.entries:
+            count('geocode_cache_hits')
+            cache.entries.move_to_end(key)
+            return cache.entries[key]
 
-        c = congestions[i]
-        for edge in highways[c.way_id].edges:
-            graph.edges[edge]['congestion'] = c.current
+    # the backend is called without the lock so that slow queries do not block the others
+    count('geocode_cache_misses')
+    with span('igo.geocode_backend'):
+        coordinates = cache.backend(query)
 
-    if context is not None:
-        context.bot.editMessageText(chat_id=chat_id,
-                                    message_id=message_id,
-                                    text="100%, graph updated")
+    with cache.lock:
+        cache.entries[key] = coordinates
+        while len(cache.entries) > cache.capacity:
+            cache.entries.popitem(last=False)
+        entries = dict(cache.entries)
 
-    # finally we add the itime to the edges
-    graph = add_itime(graph)
-    return graph
+    # the file is written without the lock, so the other queries do not wait for it
+    if cache.filename is not None:
+        save_geocodes(entries, cache.filename)
+    return coordinates
 
 
-def force_maxspeed(graph):
+def save_geocodes(entries, filename):
     '''
-    Auxiliar method of build_igraph
-    Returns the graph with all edges with maxspeed
+    Auxiliar method of geocode
+    Stores the queries of a geocode cache in its file, atomically: it is written in a temporary
+    file which then replaces it, so a crash or another process never leave it half written
     Arguments:
-        graph -> graph of the streets
+        entries -> coordinates of each query (dictionary)
+        filename -> filename where the cache is stored (string ended in ".geocodes")
     Complexity:
-        O(m) where m is the number of edges in the graph
+        O(q) where q is the number of queries
     '''
 
-    for e in graph.edges.items():
-        if 'maxspeed' not in e[1]:
-
-            # if highway of the edge is a list, take the most relevant element
-            if isinstance(e[1]['highway'], list):
-                if 'residential' in e[1]['highway']:
-                    e[1]['highway'] = 'residential'
-                elif 'secondary' in e[1]['highway'] or 'primary' in e[1]['highway'] or 'primary_link' in e[1]['highway']:
-                    e[1]['highway'] = 'primary'
-                elif 'residential' in e[1]['highway'] or 'tertiary' in e[1]['highway']:
-                    e[1]['highway'] = 'residential'
-                elif 'living_street' in e[1]['highway']:
-                    e[1]['highway'] = 'living_street'
-                elif 'unclassified' in e[1]['highway']:
-                    e[1]['highway'] = 'unclassified'
-
-            # set a maxspeed for the edge depending on the type of road ("highway") it is
-            if e[1]['highway'] == 'trunk_link':
-                e[1]['maxspeed'] = '60'
-            elif e[1]['highway'] == 'secondary' or e[1]['highway'] == 'primary' or e[1]['highway'] == 'primary_link':
-                e[1]['maxspeed'] = '50'
-            elif e[1]['highway'] == 'residential' or e[1]['highway'] == 'tertiary':
-                e[1]['maxspeed'] = '30'
-            elif e[1]['highway'] == 'living_street':
-                e[1]['maxspeed'] = '20'
-            elif e[1]['highway'] == 'unclassified':
-                e[1]['maxspeed'] = '10'
+    temporary = '{}.{}.{}'.format(filename, os.getpid(), threading.get_ident())
+    with open(temporary, 'wb') as file:
+        pickle.dump(entries, file)
+    os.replace(temporary, filename)
 
-    return graph
 
+# cache used when no other one is given
+default_geocode_cache = new_geocode_cache()
 
-def add_time_and_0congestion(graph):
+
+@timed()
+def travel_time_matrix(igraph, origins, destinations, paths=False, geocode_cache=default_geocode_cache):
     '''
-    Auxiliar method of build_igraph
-    Returns the graph with all edges with congestion = 0 and time (with no congestion)
+    Returns the matrix with the itime of the fastest path from each origin to each destination
+    (inf if there is no path) and, optionally, the matrix with the nodes of those paths (None if there is no path)
+    All the points are snapped at once and there is a single search for each origin,
+    which stops when all the destinations have been reached
     Arguments:
-        graph -> graph with all edges with maxspeed
+        igraph -> igraph of the streets of the city
+        origins, destinations -> points (vectors of strings with geocodes or tuples with coordinates)
+        paths -> whether the paths are also returned (bool)
+        geocode_cache -> cache used to geocode the points (GeocodeCache)
     Complexity:
-        O(m) where m is the number of edges in the graph
+        O(N * m log n) where N is the number of origins and n and m are the number of nodes and edges,
+        but each search usually visits only the part of the graph closer than the farthest destination
     '''
 
-    for e in graph.edges.items():
-        if isinstance(e[1]['maxspeed'], list):
-            e[1]['maxspeed'] = max(e[1]['maxspeed'])
-        e[1]['time'] = e[1]['length'] / float(e[1]['maxspeed'])
-        e[1]['congestion'] = 0
-    return graph
+    # they can be any iterable, so they are only read once
+    origins = list(origins)
+    destinations = list(destinations)
+    points = [to_coordinates(point, geocode_cache) for point in origins + destinations]
+    nodes = nearest_nodes(get_node_index(igraph), [point[1] for point in points], [point[0] for point in points]).tolist()
+    adjacency = get_adjacency(igraph)
+    positions = [adjacency.positions[node] for node in nodes]
+    sources = positions[:len(origins)]
+    targets = positions[len(origins):]
+
+    matrix = np.full((len(sources), len(targets)), np.inf)
+    path_matrix = [[None] * len(targets) for source in sources]
+    for i, source in enumerate(sources):
+        dist, parent = one_to_many(igraph, source, targets)
+        for j, target in enumerate(targets):
+            if target in dist:
+                matrix[i, j] = dist[target]
+                if paths:
+                    path_matrix[i][j] = rebuild_path(igraph, parent, target)
+
+    if paths:
+        return matrix, path_matrix
+    return matrix
+
+
+def to_coordinates(point, geocode_cache=default_geocode_cache):
+    '''
+    Auxiliar method of travel_time_matrix and snap_trip
+    Returns the coordinates (latitude, longitude) of a point
+    Arguments:
+        point -> string with a geocode or tuple with coordinates
+        geocode_cache -> cache used to geocode the point (GeocodeCache)
+    Complexity:
+        O(1) if the point is a tuple, otherwise same as geocode
+    '''
+
+    if type(point) == str:
+        return geocode(geocode_cache, point)
+    return point
 
 
-def add_itime(graph):
+def one_to_many(igraph, source, targets):
     '''
-    Auxiliar method of build_igraph
-    Returns the graph with all edges with itime
+    Auxiliar method of travel_time_matrix
+    Returns the itime from a node to the nodes reached by a Dijkstra search that stops
+    when all the targets have been reached, and the parent of each of those nodes
     Arguments:
-        graph -> graph with all edges with time and congestion
+        igraph -> igraph of the streets of the city
+        source -> position of the origin in the arrays of the graph (int)
+        targets -> positions of the destinations in the arrays of the graph (vector of ints)
     Complexity:
-        O(m) where m is the number of edges in the graph
+        O(m log n) where n and m are the number of nodes and edges
     '''
 
-    # each congestion type multiplies the time a given amount
-    multipliers = [1.1, 1, 1.2, 1.5, 2, 4, 1e12]
-    for e in graph.edges.items():
-        e[1]['itime'] = e[1]['time'] * multipliers[e[1]['congestion']]
+    adjacency = get_adjacency(igraph)
+    indptr = adjacency.indptr
+    indices = adjacency.indices
+    itime = igraph.graph['itime']
+
+    remaining = set(targets)
+    dist = {source: 0.0}
+    parent = {source: None}
+    done = set()
+    queue = [(0.0, source)]
+    while queue and remaining:
+        d, u = heapq.heappop(queue)
+        if u in done:
+            continue
+        done.add(u)
+        remaining.discard(u)
+        for e in range(indptr[u], indptr[u+1]):
+            v = indices[e]
+            if v not in done and d + float(itime[e]) < dist.get(v, math.inf):
+                dist[v] = d + float(itime[e])
+                parent[v] = u
+                heapq.heappush(queue, (dist[v], v))
+
+    # nodes that have been reached but not settled may not have their final itime
+    return {u: dist[u] for u in done}, parent
+
+
+def rebuild_path(igraph, parent, target):
+    '''
+    Returns the nodes of the path found by a search, going back from the destination
+    Arguments:
+        igraph -> igraph of the streets of the city
+        parent -> parent of each position reached by the search (dictionary)
+        target -> position of the destination in the arrays of the graph (int)
+    Complexity:
+        O(k) where k is the number of nodes on the path
+    '''
 
-    return graph
+    nodes = get_graph_arrays(igraph).nodes
+    path = []
+    u = target
+    while u is not None:
+        path.append(nodes[u].item())
+        u = parent[u]
+    return path[::-1]
 
 
-def do_path(igraph, begin, end, PATH_FILENAME, SIZE):
+def do_path(igraph, begin, end, PATH_FILENAME, SIZE, geocode_cache=default_geocode_cache, time_dependent=False):
     '''
     Get a map with the fastest path from one point to another plotted
     Arguments:
@@ -321,15 +1775,49 @@ def do_path(igraph, begin, end, PATH_FILENAME, SIZE):
         end -> destination of the trajectory (string eith geocode or tuple with coordinates)
         PATH_FILENAME -> filename where the map has to be stored (string ended in ".png")
         SIZE -> size of the map
+        geocode_cache -> cache used to geocode begin and end (GeocodeCache)
+        time_dependent -> whether the predicted congestion is used for the later part of the trip (bool)
     Complexity:
-        same as osmnx.shortest_path
+        same as get_shortest_path_with_ispeeds
     '''
 
-    path = get_shortest_path_with_ispeeds(igraph, begin, end)
+    path = get_shortest_path_with_ispeeds(igraph, begin, end, geocode_cache, time_dependent)
     plot_path(igraph, path, PATH_FILENAME, SIZE)
 
 
-def get_shortest_path_with_ispeeds(igraph, begin, end):
+def do_path_image(igraph, begin, end, SIZE, geocode_cache=default_geocode_cache, time_dependent=False,
+                  route_cache=None):
+    '''
+    Same as do_path, but returns the png image (bytes) of the map instead of storing it in a file
+    Arguments:
+        igraph -> igraph of the streets of the city
+        begin -> origin of the trajectory (string eith geocode or tuple with coordinates)
+        end -> destination of the trajectory (string eith geocode or tuple with coordinates)
+        SIZE -> size of the map
+        geocode_cache -> cache used to geocode begin and end (GeocodeCache)
+        time_dependent -> whether the predicted congestion is used for the later part of the trip (bool)
+        route_cache -> cache of the routes already computed with this congestion snapshot (RouteCache) or None
+    Complexity:
+        O(1) if the route is in the cache, otherwise same as get_shortest_path_with_ispeeds
+    '''
+
+    # the version is read before the route so that a route is never stored with a newer version
+    version = igraph.graph['version']
+    begin, end = snap_trip(igraph, begin, end, geocode_cache)
+    key = (version, begin, end, time_dependent, SIZE)
+    if route_cache is not None:
+        route = get_cached_route(route_cache, key)
+        if route is not None:
+            return route[1]
+
+    path = shortest_path_between_nodes(igraph, begin, end, time_dependent)
+    image = render_path(igraph, path, SIZE)
+    if route_cache is not None:
+        put_cached_route(route_cache, key, path, image)
+    return image
+
+
+def get_shortest_path_with_ispeeds(igraph, begin, end, geocode_cache=default_geocode_cache, time_dependent=False):
     '''
     Auxiliar method of do_path
     Returns the nodes of the fastest path
@@ -337,21 +1825,150 @@ def get_shortest_path_with_ispeeds(igraph, begin, end):
         igraph -> igraph of the streets of the city
         begin -> origin of the trajectory (string eith geocode or tuple with coordinates)
         end -> destination of the trajectory (string eith geocode or tuple with coordinates)
+        geocode_cache -> cache used to geocode begin and end (GeocodeCache)
+        time_dependent -> whether the predicted congestion is used for the later part of the trip (bool)
+    Complexity:
+        same as alt_shortest_path (or td_shortest_path)
+    '''
+
+    begin, end = snap_trip(igraph, begin, end, geocode_cache)
+    return shortest_path_between_nodes(igraph, begin, end, time_dependent)
+
+
+@timed()
+def snap_trip(igraph, begin, end, geocode_cache=default_geocode_cache):
+    '''
+    Auxiliar method of get_shortest_path_with_ispeeds
+    Returns the nodes closest to the origin and the destination of a trajectory
+    Arguments:
+        igraph -> igraph of the streets of the city
+        begin -> origin of the trajectory (string eith geocode or tuple with coordinates)
+        end -> destination of the trajectory (string eith geocode or tuple with coordinates)
+        geocode_cache -> cache used to geocode begin and end (GeocodeCache)
     Complexity:
-        same as osmnx.shortest_path
+        O(log n) where n is the number of nodes (plus the geocoding)
     '''
 
     # converts begin and end into its respective nodes
-    if type(begin) == str:
-        begin = osmnx.geocode(begin + ", Barcelona")
-    if type(end) == str:
-        end = osmnx.geocode(end + ", Barcelona")
-    begin = my_nearest_node(igraph, begin[1], begin[0])
-    end = my_nearest_node(igraph, end[1], end[0])
-    # we reuse the function we have already built
+    begin = to_coordinates(begin, geocode_cache)
+    end = to_coordinates(end, geocode_cache)
+    # both points are snapped in a single query to the node index
+    begin, end = nearest_nodes(get_node_index(igraph), [begin[1], end[1]], [begin[0], end[0]]).tolist()
+    return begin, end
+
+
+def shortest_path_between_nodes(igraph, begin, end, time_dependent=False):
+    '''
+    Auxiliar method of get_shortest_path_with_ispeeds
+    Returns the nodes of the fastest path between two nodes
+    Arguments:
+        igraph -> igraph of the streets of the city
+        begin, end -> nodes of the origin and destination
+        time_dependent -> whether the predicted congestion is used for the later part of the trip (bool)
+    Complexity:
+        same as alt_shortest_path (or td_shortest_path)
+    '''
+
+    if time_dependent:
+        path, seconds = td_shortest_path(igraph, begin, end)
+        return path
+    return alt_shortest_path(igraph, begin, end)
+
+
+def path_totals(igraph, path):
+    '''
+    Returns the itime (with the current congestion) and the length in meters of a path
+    Arguments:
+        igraph -> igraph of the streets of the city
+        path -> nodes of the path
+    Complexity:
+        O(k) where k is the number of nodes on the path
+    '''
+
+    table = get_edge_table(igraph)
+    ids = [igraph.edges[(path[i], path[i+1])]['edge_id'] for i in range(len(path)-1)]
+    return float(igraph.graph['itime'][ids].sum()), float(table.length[ids].sum())
+
+
+def new_route_cache(capacity=1024, max_bytes=64 * 2**20):
+    '''
+    Returns an empty route cache
+    Arguments:
+        capacity -> maximum number of routes kept (int)
+        max_bytes -> maximum number of bytes of the images kept (int)
+    Complexity:
+        O(1)
+    '''
+
+    return RouteCache(collections.OrderedDict(), capacity, max_bytes, threading.Lock(),
+                      {'bytes': 0, 'hits': 0, 'misses': 0})
+
+
+def get_cached_route(cache, key):
+    '''
+    Auxiliar method of do_path_image
+    Returns the path and image of a route in the cache, or None if it is not there
+    The routes of older congestion snapshots are removed from the cache
+    Arguments:
+        cache -> route cache (RouteCache)
+        key -> version of the igraph, origin and destination nodes, mode and size of the map (tuple)
+    Complexity:
+        O(1) amortized
+    '''
+
+    with cache.lock:
+        # routes of older versions are never used again, so they are all at the beginning
+        while cache.entries and next(iter(cache.entries))[0] < key[0]:
+            remove_cached_route(cache)
+
+        if key not in cache.entries:
+            cache.stats['misses'] += 1
+            count('route_cache_misses')
+            return None
+        cache.stats['hits'] += 1
+        count('route_cache_hits')
+        cache.entries.move_to_end(key)
+        return cache.entries[key]
+
+
+def put_cached_route(cache, key, path, image):
+    '''
+    Auxiliar method of do_path_image
+    Stores the path and the image of a route in the cache,
+    removing the least recently used routes if the cache is full
+    Arguments:
+        cache -> route cache (RouteCache)
+        key -> version of the igraph, origin and destination nodes, mode and size of the map (tuple)
+        path -> nodes of the route
+        image -> png image of the map of the route (bytes)
+    Complexity:
+        O(1) amortized
+    '''
 
-    # and returns its shortest_path
-    return osmnx.shortest_path(igraph, begin, end, weight='itime')
+    with cache.lock:
+        # a route computed with an older snapshot while the new one arrived is not stored
+        if cache.entries and next(reversed(cache.entries))[0] > key[0]:
+            return
+        if key in cache.entries:
+            return
+        cache.entries[key] = (path, image)
+        cache.stats['bytes'] += len(image)
+        while len(cache.entries) > cache.capacity or cache.stats['bytes'] > cache.max_bytes:
+            remove_cached_route(cache)
+
+
+def remove_cached_route(cache):
+    '''
+    Auxiliar method of get_cached_route and put_cached_route
+    Removes the least recently used route of the cache (the lock must be held)
+    Arguments:
+        cache -> route cache (RouteCache)
+    Complexity:
+        O(1)
+    '''
+
+    key, (path, image) = cache.entries.popitem(last=False)
+    cache.stats['bytes'] -= len(image)
 
 
 def plot_path(igraph, path, PATH_FILENAME, SIZE):
@@ -363,18 +1980,246 @@ def plot_path(igraph, path, PATH_FILENAME, SIZE):
         path -> nodes of the fastest path
         PATH_FILENAME -> filename where the map has to be stored (string ended in ".png")
         SIZE -> size of the map
+    Complexity:
+        same as render_path
+    '''
+
+    with open(PATH_FILENAME, 'wb') as file:
+        file.write(render_path(igraph, path, SIZE))
+
+
+@timed()
+def render_path(igraph, path, SIZE):
+    '''
+    Auxiliar method of plot_path and do_path_image
+    Returns the png image (bytes) of the map with the path plotted
+    Arguments:
+        igraph -> igraph of the streets of the city
+        path -> nodes of the fastest path
+        SIZE -> size of the map
     Complexity:
         O(n) where n is the number of nodes on the path
     '''
 
     # if the congestion is high, we mark it in the corresponding color
     congestion_colors = ["blue", "blue", "blue", "yellow", "orange", "red", "black"]
-    m = StaticMap(SIZE, SIZE)
+    congestion = igraph.graph['congestion']
+    m = CachedStaticMap(SIZE, SIZE)
     for i in range(len(path)-1):
         # plot each edge into the map with a color representing its congestion
         node1 = igraph.nodes[path[i]]
         node2 = igraph.nodes[path[i+1]]
-        color = congestion_colors[igraph.edges[(path[i], path[i+1])]['congestion']]
+        color = congestion_colors[congestion[igraph.edges[(path[i], path[i+1])]['edge_id']]]
         m.add_line(Line(((node1['x'], node1['y']), (node2['x'], node2['y'])), color, 5))
 
-    m.render().save(PATH_FILENAME)
+    return map_to_png(m)
+
+
+@timed()
+def render_location(lat, lon, SIZE):
+    '''
+    Returns the png image (bytes) of the map with a location marked
+    Arguments:
+        lat, lon -> coordinates of the location
+        SIZE -> size of the map
+    Complexity:
+        same as StaticMap functions
+    '''
+
+    m = CachedStaticMap(SIZE, SIZE)
+    m.add_marker(CircleMarker((lon, lat), 'blue', 15))
+    return map_to_png(m)
+
+
+def map_to_png(m):
+    '''
+    Returns the png image (bytes) of a map, rendered in memory
+    so that several requests can render at the same time
+    Arguments:
+        m -> map (StaticMap)
+    Complexity:
+        same as StaticMap.render
+    '''
+
+    image = io.BytesIO()
+    m.render().save(image, format='png')
+    return image.getvalue()
+
+
+def new_city_registry(cities, max_bytes=4 * 2**30, processes=1):
+    '''
+    Returns a registry of cities where none is loaded yet
+    Arguments:
+        cities -> cities that can be loaded (vector of City)
+        max_bytes -> maximum number of bytes of the loaded cities (int)
+        processes -> number of processes that build the highways of a city (int)
+    Complexity:
+        O(k) where k is the number of cities
+    '''
+
+    return CityRegistry({city.name: city for city in cities}, collections.OrderedDict(), max_bytes, processes,
+                        threading.Lock(), {}, {'bytes': 0, 'loads': 0, 'evictions': 0}, {})
+
+
+def get_city(registry, name):
+    '''
+    Returns a loaded city, loading it the first time it is asked for
+    (the least recently used cities are evicted when the loaded ones take more than max_bytes,
+    but never the one just loaded)
+    Raises KeyError if the city is not in the registry
+    Arguments:
+        registry -> registry of the cities (CityRegistry)
+        name -> name of the city (string)
+    Complexity:
+        O(1) if already loaded, otherwise same as load_city
+    '''
+
+    city = registry.cities[name]
+    with registry.lock:
+        if name in registry.entries:
+            registry.entries.move_to_end(name)
+            return registry.entries[name]
+        loading = registry.loading.setdefault(name, threading.Lock())
+
+    # the city is loaded without the lock of the registry, so the other cities can be used meanwhile,
+    # and only once even if it is asked for several times at once
+    with loading:
+        with registry.lock:
+            if name in registry.entries:
+                registry.entries.move_to_end(name)
+                return registry.entries[name]
+
+        loaded = load_city(city, registry.processes, get_geocode_cache(registry, name))
+        with registry.lock:
+            registry.entries[name] = loaded
+            registry.stats['bytes'] += loaded.nbytes
+            registry.stats['loads'] += 1
+            count('city_loads')
+            while registry.stats['bytes'] > registry.max_bytes and len(registry.entries) > 1:
+                evicted_name, evicted = registry.entries.popitem(last=False)
+                registry.stats['bytes'] -= evicted.nbytes
+                registry.stats['evictions'] += 1
+                count('city_evictions')
+    return loaded
+
+
+def get_geocode_cache(registry, name):
+    '''
+    Returns the geocode cache of a city, without loading the city
+    (it is created the first time and kept while the city is evicted and loaded again)
+    Raises KeyError if the city is not in the registry
+    Arguments:
+        registry -> registry of the cities (CityRegistry)
+        name -> name of the city (string)
+    Complexity:
+        O(1), except the first time, that is same as new_geocode_cache
+    '''
+
+    city = registry.cities[name]
+    with registry.lock:
+        if name not in registry.geocode_caches:
+            registry.geocode_caches[name] = new_geocode_cache(functools.partial(osmnx_geocoder, place=city.place),
+                                                              filename=city.geocodes_filename)
+        return registry.geocode_caches[name]
+
+
+@timed()
+def load_city(city, processes=1, geocode_cache=None):
+    '''
+    Auxiliar method of get_city
+    Returns the city loaded in memory, without any congestion snapshot yet
+    Arguments:
+        city -> city to load (City)
+        processes -> number of processes that build the highways (int)
+        geocode_cache -> cache used to geocode the addresses of the city (GeocodeCache, a new one by default)
+    Complexity:
+        same as get_graph, get_highways and get_landmarks
+    '''
+
+    graph = get_graph(city.graph_filename, city.place)
+    highways = get_highways(city.highways_url, graph, city.graph_filename, city.highways_filename, processes)
+    # the routing preprocessing does not depend on the congestions, so it is done only once
+    get_landmarks(graph)
+    if geocode_cache is None:
+        geocode_cache = new_geocode_cache(functools.partial(osmnx_geocoder, place=city.place),
+                                          filename=city.geocodes_filename)
+    route_cache = new_route_cache()
+    nbytes = city_bytes(graph, highways) + route_cache.max_bytes
+    return LoadedCity(city, graph, highways, geocode_cache, route_cache, None, nbytes)
+
+
+def city_bytes(graph, highways):
+    '''
+    Auxiliar method of load_city
+    Returns the approximate number of bytes a graph and its highways take
+    Arguments:
+        graph -> graph of the streets
+        highways -> streets whose congestions we know (HighwayStore)
+    Complexity:
+        O(1)
+    '''
+
+    return graph.number_of_edges() * EDGE_BYTES + sum(column.nbytes for column in highways
+                                                      if isinstance(column, np.ndarray))
+
+
+def loaded_cities(registry):
+    '''
+    Returns the names of the cities that are loaded now
+    Arguments:
+        registry -> registry of the cities (CityRegistry)
+    Complexity:
+        O(k) where k is the number of loaded cities
+    '''
+
+    with registry.lock:
+        return list(registry.entries.keys())
+
+
+def refresh_city(registry, name):
+    '''
+    Downloads the congestions of a loaded city if they have changed and stores its new snapshot,
+    building the igraph the first time and updating it afterwards
+    Returns whether a new snapshot was stored (not if the congestions have not changed,
+    or the city has been evicted or refreshed by someone else meanwhile)
+    If the server sends the same congestions again, only the validators of the snapshot are replaced,
+    so the next download can be answered with 304
+    Arguments:
+        registry -> registry of the cities (CityRegistry)
+        name -> name of the city (string)
+    Complexity:
+        O(1) if the congestions have not changed,
+        same as build_igraph the first time,
+        same as update_igraph afterwards
+    '''
+
+    with registry.lock:
+        loaded = registry.entries.get(name)
+    if loaded is None:
+        return False
+
+    snapshot = loaded.snapshot
+    validators = None if snapshot is None else snapshot.validators
+    congestions, validators = download_congestions_if_modified(loaded.city.congestions_url, validators)
+    if congestions is None:
+        return False
+    if snapshot is not None and congestions == snapshot.congestions:
+        if validators != snapshot.validators:
+            with registry.lock:
+                current = registry.entries.get(name)
+                if current is not None and current.snapshot is snapshot:
+                    registry.entries[name] = current._replace(snapshot=snapshot._replace(validators=validators))
+        return False
+
+    if snapshot is None:
+        igraph = build_igraph(loaded.graph, loaded.highways, congestions)
+    else:
+        igraph = update_igraph(snapshot.igraph, loaded.highways, snapshot.congestions, congestions)
+
+    # the loaded city is replaced as a whole, so the requests that are using the previous snapshot keep it
+    with registry.lock:
+        current = registry.entries.get(name)
+        if current is None or current.graph is not loaded.graph or current.snapshot is not snapshot:
+            return False
+        registry.entries[name] = current._replace(snapshot=Snapshot(congestions, igraph, validators))
+    return True
@@ -0,0 +1,190 @@
+import collections
+import contextlib
+import cProfile
+import functools
+import http.server
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+
+# Time spent in each stage: number of times, total seconds and maximum seconds
+Span = collections.namedtuple('Span', 'count, total, max')
+
+logger = logging.getLogger('igo')
+
+# spans and counters of the process
+spans = {}
+counters = collections.Counter()
+lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(name):
+    '''
+    Measures the time spent inside the with block as a stage with the given name
+    Arguments:
+        name -> name of the stage (string)
+    Complexity:
+        O(1)
+    '''
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with lock:
+            previous = spans.get(name, Span(0, 0.0, 0.0))
+            spans[name] = Span(previous.count + 1, previous.total + seconds, max(previous.max, seconds))
+
+
+def timed(name=None):
+    '''
+    Decorator that measures the time spent in a function as a stage
+    Arguments:
+        name -> name of the stage (string), by default the module and name of the function
+    Complexity:
+        O(1)
+    '''
+
+    def decorator(function):
+        stage = name if name is not None else function.__module__ + '.' + function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(event, amount=1):
+    '''
+    Adds an amount to the counter of an event (cache hits, downloads...)
+    Arguments:
+        event -> name of the event (string)
+        amount -> amount added (int)
+    Complexity:
+        O(1)
+    '''
+
+    with lock:
+        counters[event] += amount
+
+
+def metrics_text():
+    '''
+    Returns the spans and counters in the text format of Prometheus
+    Complexity:
+        O(s + c) where s is the number of stages and c the number of counters
+    '''
+
+    with lock:
+        current_spans = dict(spans)
+        current_counters = dict(counters)
+
+    lines = ['# TYPE igo_stage_seconds summary']
+    for name, s in sorted(current_spans.items()):
+        lines.append('igo_stage_seconds_count{{stage="{}"}} {}'.format(name, s.count))
+        lines.append('igo_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(name, s.total))
+    lines.append('# TYPE igo_stage_seconds_max gauge')
+    for name, s in sorted(current_spans.items()):
+        lines.append('igo_stage_seconds_max{{stage="{}"}} {:.6f}'.format(name, s.max))
+    lines.append('# TYPE igo_events_total counter')
+    for event, amount in sorted(current_counters.items()):
+        lines.append('igo_events_total{{event="{}"}} {}'.format(event, amount))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Handler of the http server of the metrics, which answers /metrics
+    '''
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the requests of the metrics scraper are not logged
+        pass
+
+
+def serve_metrics(port, host='127.0.0.1'):
+    '''
+    Starts an http server in the background that exports the metrics in /metrics
+    Returns the server (to stop it, call its shutdown method)
+    Arguments:
+        port -> port of the server (int)
+        host -> address of the server (string)
+    Complexity:
+        O(1)
+    '''
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@contextlib.contextmanager
+def profile_if_slow(name, threshold, sample=1.0):
+    '''
+    Profiles (with cProfile) a sample of the executions of the with block
+    and logs the functions that took more time when the execution is slower than the threshold
+    Arguments:
+        name -> name of the block (string)
+        threshold -> seconds from which the execution is slow (float)
+        sample -> fraction of the executions that are profiled (float)
+    Complexity:
+        O(1) (plus the overhead of the profiler in the sampled executions)
+    '''
+
+    profiler = cProfile.Profile() if random.random() < sample else None
+    start = time.perf_counter()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:
+            # another execution is already being profiled
+            profiler = None
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            if seconds > threshold:
+                count('slow_' + name)
+                report = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(20)
+                logger.warning('%s took %.2f seconds:\n%s', name, seconds, report.getvalue())
+
+
+def profiled(name, threshold, sample=1.0):
+    '''
+    Decorator that does profile_if_slow with all the executions of a function
+    Arguments:
+        name -> name of the function in the logs (string)
+        threshold -> seconds from which the execution is slow (float)
+        sample -> fraction of the executions that are profiled (float)
+    Complexity:
+        O(1)
+    '''
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_if_slow(name, threshold, sample):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
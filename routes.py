@@ -0,0 +1,297 @@
+import argparse
+import collections
+import csv
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import networkx
+import igo
+
+# Each trip of the input: its id, origin and destination
+# (strings with geocodes or tuples with coordinates)
+Trip = collections.namedtuple('Trip', 'id, origin, destination')
+
+HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
+CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
+# Fields of each route in the output
+FIELDS = ['id', 'origin_node', 'destination_node', 'itime', 'seconds', 'distance', 'path', 'error']
+
+
+def read_trips(source, format):
+    '''
+    Returns an iterator over the trips of a csv or jsonl file, reading it line by line
+    In a csv, each row has an origin and a destination, either as addresses or as
+    "latitude longitude" (columns origin and destination) or as four columns
+    origin_lat, origin_lon, destination_lat and destination_lon
+    In a jsonl, each line is an object with an origin and a destination, either addresses or [latitude, longitude]
+    In both, the id of the trip is optional (by default, its number of line)
+    A row that cannot be read is a trip with None as origin and destination, so its route has a 'parse' error
+    Arguments:
+        source -> filename, url or '-' for the standard input (string)
+        format -> 'csv' or 'jsonl' (string)
+    Complexity:
+        O(1) for each trip
+    '''
+
+    lines = sys.stdin if source == '-' else igo.open_lines(source)
+    if format == 'jsonl':
+        rows = (parse_json(line) for line in lines if line.strip())
+    else:
+        rows = csv.DictReader(lines)
+
+    for number, row in enumerate(rows):
+        id = row.get('id', number) if isinstance(row, dict) else number
+        try:
+            if 'origin_lat' in row:
+                origin = (float(row['origin_lat']), float(row['origin_lon']))
+                destination = (float(row['destination_lat']), float(row['destination_lon']))
+            else:
+                origin = to_point(row['origin'])
+                destination = to_point(row['destination'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            origin = destination = None
+        yield Trip(id, origin, destination)
+
+
+def parse_json(line):
+    '''
+    Auxiliar method of read_trips
+    Returns the object of a json line, or None if it is not valid json
+    Complexity:
+        O(1)
+    '''
+
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def to_point(value):
+    '''
+    Auxiliar method of read_trips
+    Returns a point as igo expects it: a tuple with coordinates, or a string with a geocode
+    Arguments:
+        value -> address, "latitude longitude" or [latitude, longitude] (string or vector)
+    Complexity:
+        O(1)
+    '''
+
+    if isinstance(value, list):
+        return tuple(float(coordinate) for coordinate in value)
+    try:
+        latitude, longitude = value.split()
+        return (float(latitude), float(longitude))
+    except ValueError:
+        return value
+
+
+def snap_trips(igraph, trips, geocode_cache):
+    '''
+    Returns the id and the nodes closest to the origin and destination of each trip,
+    snapping all the points of the trips at once (None instead of the nodes and the error
+    if a point cannot be read or geocoded)
+    Arguments:
+        igraph -> igraph of the streets of the city
+        trips -> trips to snap (vector of Trip)
+        geocode_cache -> cache used to geocode the addresses (GeocodeCache)
+    Complexity:
+        O(t log n) where t is the number of trips and n the number of nodes (plus the geocoding)
+    '''
+
+    points = []
+    failed = {}
+    for i, trip in enumerate(trips):
+        if trip.origin is None:
+            failed[i] = 'parse'
+            points += [(0.0, 0.0), (0.0, 0.0)]
+            continue
+        try:
+            points += [igo.to_coordinates(trip.origin, geocode_cache), igo.to_coordinates(trip.destination, geocode_cache)]
+        except Exception:
+            failed[i] = 'geocode'
+            points += [(0.0, 0.0), (0.0, 0.0)]
+
+    nodes = igo.nearest_nodes(igo.get_node_index(igraph), [p[1] for p in points], [p[0] for p in points]).tolist()
+    return [(trip.id, None, None, failed[i]) if i in failed else (trip.id, nodes[2*i], nodes[2*i + 1], None)
+            for i, trip in enumerate(trips)]
+
+
+def route_trip(igraph, snapped, time_dependent=False):
+    '''
+    Returns the route of a snapped trip: its id, nodes, itime, seconds, distance in meters, path and error
+    Arguments:
+        igraph -> igraph of the streets of the city
+        snapped -> id, nodes of the origin and destination and error of the trip (tuple)
+        time_dependent -> whether the predicted congestion is used for the later part of the trip (bool)
+    Complexity:
+        same as igo.shortest_path_between_nodes
+    '''
+
+    id, begin, end, error = snapped
+    route = dict.fromkeys(FIELDS)
+    route.update(id=id, origin_node=begin, destination_node=end)
+    if error is not None:
+        route['error'] = error
+        return route
+    try:
+        if time_dependent:
+            path, seconds = igo.td_shortest_path(igraph, begin, end)
+            itime = seconds / igo.SECONDS_PER_TIME
+            distance = igo.path_totals(igraph, path)[1]
+        else:
+            path = igo.alt_shortest_path(igraph, begin, end)
+            itime, distance = igo.path_totals(igraph, path)
+    except networkx.NetworkXNoPath:
+        route['error'] = 'no path'
+        return route
+    route.update(itime=itime, seconds=itime * igo.SECONDS_PER_TIME, distance=distance, path=path)
+    return route
+
+
+# igraph of the city and mode of the routes in each of the processes of route_trips
+worker_igraph = None
+worker_time_dependent = False
+
+
+def init_routes_worker(igraph, time_dependent):
+    '''
+    Auxiliar method of route_trips
+    Stores the igraph in the process, so that it is not sent with every trip
+    Complexity:
+        O(1)
+    '''
+
+    global worker_igraph, worker_time_dependent
+    worker_igraph = igraph
+    worker_time_dependent = time_dependent
+
+
+def route_trip_in_worker(snapped):
+    '''
+    Auxiliar method of route_trips
+    Same as route_trip, with the igraph of the process
+    Complexity:
+        same as route_trip
+    '''
+
+    return route_trip(worker_igraph, snapped, worker_time_dependent)
+
+
+def route_trips(igraph, trips, geocode_cache, processes=1, batch_size=1024, time_dependent=False):
+    '''
+    Returns an iterator over the routes of the trips, in the same order
+    The trips are read and snapped in batches and routed in several processes, each of them
+    receiving the igraph only once; at most two batches are kept in memory at the same time
+    Arguments:
+        igraph -> igraph of the streets of the city
+        trips -> trips to route (iterable of Trip)
+        geocode_cache -> cache used to geocode the addresses (GeocodeCache)
+        processes -> number of processes that route the trips (int)
+        batch_size -> number of trips snapped at once (int)
+        time_dependent -> whether the predicted congestion is used for the later part of the trips (bool)
+    Complexity:
+        same as route_trip for each trip (divided among the processes)
+    '''
+
+    # the routing preprocessing is done before creating the processes so that all of them share it
+    igo.get_adjacency(igraph)
+    igo.get_landmarks(igraph)
+    igo.get_node_index(igraph)
+    trips = iter(trips)
+    batches = iter(lambda: list(itertools.islice(trips, batch_size)), [])
+
+    if processes <= 1:
+        for batch in batches:
+            for snapped in snap_trips(igraph, batch, geocode_cache):
+                yield route_trip(igraph, snapped, time_dependent)
+        return
+
+    with multiprocessing.Pool(processes, initializer=init_routes_worker, initargs=(igraph, time_dependent)) as pool:
+        # the next batch is snapped while the processes route the previous one
+        pending = collections.deque()
+        for batch in batches:
+            snapped = snap_trips(igraph, batch, geocode_cache)
+            pending.append(pool.imap(route_trip_in_worker, snapped, chunksize=max(1, len(snapped) // (4 * processes))))
+            if len(pending) > 1:
+                yield from pending.popleft()
+        while pending:
+            yield from pending.popleft()
+
+
+def write_routes(routes, file, format):
+    '''
+    Writes each route to the file as soon as it is computed, as a csv row
+    (with the nodes of the path separated by spaces) or as a json line
+    Arguments:
+        routes -> routes of the trips (iterable of dictionaries)
+        file -> opened file where they are written
+        format -> 'csv' or 'jsonl' (string)
+    Complexity:
+        O(k) for each route, where k is the number of nodes of its path
+    '''
+
+    if format == 'jsonl':
+        for route in routes:
+            file.write(json.dumps(route) + '\n')
+        return
+
+    writer = csv.DictWriter(file, FIELDS)
+    writer.writeheader()
+    for route in routes:
+        if route['path'] is not None:
+            route['path'] = ' '.join(map(str, route['path']))
+        writer.writerow(route)
+
+
+def file_format(filename, format):
+    '''
+    Returns the format of a file: the given one, or the one of its extension
+    Complexity:
+        O(1)
+    '''
+
+    if format is not None:
+        return format
+    return 'jsonl' if filename.endswith(('.jsonl', '.json')) else 'csv'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Computes the fastest routes of the trips of a csv or jsonl file')
+    parser.add_argument('input', help="file or url with the trips, or '-' for the standard input")
+    parser.add_argument('--output', default='-', help="file where the routes are written, or '-' for the standard output")
+    parser.add_argument('--input-format', choices=['csv', 'jsonl'], help='format of the input (by default, its extension)')
+    parser.add_argument('--output-format', choices=['csv', 'jsonl'], help='format of the output (by default, its extension)')
+    parser.add_argument('--place', default='Barcelona, Catalonia', help='city of the trips')
+    parser.add_argument('--graph', default='barcelona.graph', help='file where the graph of the city is kept')
+    parser.add_argument('--highways', default='barcelona.highways', help='file where the highways of the city are kept')
+    parser.add_argument('--highways-url', default=HIGHWAYS_URL, help='url or file of the highways csv')
+    parser.add_argument('--congestions', default=CONGESTIONS_URL, help='url or file of the congestions')
+    parser.add_argument('--geocodes', default=None, help='file where the geocoded addresses are kept')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='processes that route the trips')
+    parser.add_argument('--batch-size', type=int, default=1024, help='trips snapped at once')
+    parser.add_argument('--time-dependent', action='store_true', help='use the predicted congestion later in the trips')
+    arguments = parser.parse_args()
+
+    graph = igo.get_graph(arguments.graph, arguments.place)
+    highways = igo.get_highways(arguments.highways_url, graph, arguments.graph, arguments.highways, arguments.processes)
+    igraph = igo.build_igraph(graph, highways, igo.download_congestions(arguments.congestions))
+    geocode_cache = igo.new_geocode_cache(functools.partial(igo.osmnx_geocoder, place=arguments.place),
+                                          filename=arguments.geocodes)
+
+    trips = read_trips(arguments.input, file_format(arguments.input, arguments.input_format))
+    routes = route_trips(igraph, trips, geocode_cache, arguments.processes, arguments.batch_size,
+                         arguments.time_dependent)
+    output_format = file_format(arguments.output, arguments.output_format)
+    if arguments.output == '-':
+        write_routes(routes, sys.stdout, output_format)
+    else:
+        with open(arguments.output, 'w', newline='', encoding='utf-8') as file:
+            write_routes(routes, file, output_format)
+
+
+if __name__ == '__main__':
+    main()